@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""报表函数性能基准
+
+用合成的risk_statistics_all及risk_dimension数据，按不同规模测量各报表函数的耗时和内存峰值，
+与保存的基准比较以发现性能退化；--e2e时以SQLite替身库代替Oracle运行完整的templateBisRpt.main。
+
+    python bench.py --sizes small,medium --save   # 测量并保存基准
+    python bench.py --sizes small,medium          # 与基准比较，退化时返回1
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import DateTime, bindparam, create_engine, event, text
+
+import datastore
+import templateBisRpt as rpt
+
+# 规模：(借据数, 月份数, 省市数)
+SIZES = {'small':(2000, 24, 8), 'medium':(20000, 36, 16), 'large':(100000, 60, 31)}
+
+def _months(n_months):
+    """截至上月末的n_months个月末"""
+    return(pd.date_range(end=pd.Timestamp.today().normalize() - pd.offsets.MonthEnd(1), periods=n_months, freq=pd.offsets.MonthEnd()))
+
+def _provinces(n_provs):
+    """省市编码，首个为厦门"""
+    return(['3502'] + [str(3600 + i) for i in range(n_provs - 1)])
+
+def _stage_breaks(months):
+    """阶段起始日期：按放款月份三等分"""
+    return(pd.DatetimeIndex([months[len(months) * i // 3] - pd.offsets.MonthBegin(1) for i in range(3)]))
+
+def make_loans(n_loans, months, n_provs, seed=0):
+    """合成借据：放款月份、各报表维度及本金"""
+
+    rng = np.random.RandomState(seed)
+    provs = _provinces(n_provs)
+    p_prov = np.r_[0.3, np.full(n_provs - 1, 0.7 / max(n_provs - 1, 1))] if n_provs > 1 else None
+
+    loans = pd.DataFrame({'begin_date':months[rng.randint(0, len(months), n_loans)],
+                          'prov_cd':rng.choice(provs, n_loans, p=p_prov),
+                          'aipmchttype':rng.choice([1, 2, 3], n_loans),
+                          'loan_period_mon':rng.choice([6, 12, 24], n_loans),
+                          'repay_period':rng.choice([1, 2], n_loans),
+                          'white':rng.choice([0, 1], n_loans),
+                          'applysource':rng.choice([0, 1], n_loans, p=[0.9, 0.1]),
+                          'reloantimes':rng.choice([1, 2], n_loans, p=[0.7, 0.3]),
+                          'light':rng.choice([1, 2, 3], n_loans, p=[0.1, 0.2, 0.7]),
+                          'loan_pr':rng.randint(1, 50, n_loans) * 10000.0})
+    loans['stage'] = np.searchsorted(_stage_breaks(months), loans.begin_date.values, side='right')
+    loans['loan_pr_scope'] = np.searchsorted([1e5, 3e5], loans.loan_pr.values, side='right') + 1
+    loans['reloan'] = np.where(loans.reloantimes == 2, rng.randint(2, 5, n_loans), 1)
+
+    return(loans)
+
+def _status(loans, dt, seed):
+    """借据在dt的状态，同一日期的随机数固定，上期状态可重复生成"""
+
+    dt = pd.Timestamp(dt)
+    rng = np.random.RandomState([seed, dt.year, dt.month, dt.day])
+    age = (dt.year - loans.begin_date.dt.year.values) * 12 + dt.month - loans.begin_date.dt.month.values
+
+    status_3 = np.where(age >= loans.loan_period_mon.values, 2, (rng.rand(len(loans)) < 0.08).astype(int))
+    maturity_days = np.where(status_3 == 1, rng.randint(1, 6, len(loans)), 0)
+    od_principal = np.where(status_3 == 1, loans.loan_pr.values / loans.loan_period_mon.values * maturity_days, 0)
+
+    return({'age':age, 'overdue_status_3':status_3,
+            'overdue_status_5':np.select([status_3 != 1, maturity_days <= 2], [1, 2], 3),
+            'status':np.where(status_3 == 2, 2, 1), 'maturity_days':maturity_days,
+            'new_maturity_days':np.where(status_3 == 1, maturity_days + rng.randint(0, 2, len(loans)), 0),
+            'od_principal':od_principal, 'od_amt':od_principal * 1.1})
+
+def snapshot(loans, dt, seed=0):
+    """RISK_STAT_MONTH在dt的快照：dt前放款的借据各一行"""
+
+    dt = pd.Timestamp(dt)
+    now, last = _status(loans, dt, seed), _status(loans, dt - pd.offsets.MonthEnd(1), seed)
+    active = now['age'] >= 0
+    new_loan = now['age'] == 0
+    period = loans.loan_pr.values / loans.loan_period_mon.values
+
+    data = loans.assign(data_dt=dt, cnt=1,
+                        new_loan=new_loan.astype(int),
+                        overdue_status_3=now['overdue_status_3'],
+                        overdue_status_5=now['overdue_status_5'],
+                        overdue_status_3_last=np.where(new_loan, np.nan, last['overdue_status_3']),
+                        overdue_status_5_last=np.where(new_loan, np.nan, last['overdue_status_5']),
+                        status_last_month=np.where(new_loan, np.nan, last['status']),
+                        status_this_month=now['status'],
+                        maturity_days=now['maturity_days'],
+                        new_maturity_days=now['new_maturity_days'],
+                        bal_prin=np.where(now['overdue_status_3'] == 2, 0,
+                                          loans.loan_pr.values * np.clip(1 - now['age'] / loans.loan_period_mon.values, 0, 1)),
+                        sp_amt=period * 1.1,
+                        od_principal=now['od_principal'],
+                        od_amt=now['od_amt'],
+                        od_principal_0=np.where(now['new_maturity_days'] > 0, now['od_principal'], 0),
+                        od_amt_0=np.where(now['new_maturity_days'] > 0, now['od_amt'], 0),
+                        od_amt_30=np.where(now['maturity_days'] >= 1, now['od_amt'], 0),
+                        diff_od_amt=now['od_amt'] - np.where(new_loan, 0, last['od_amt']))
+    data['bal'] = data.bal_prin * 1.05
+
+    return(data[active].reset_index(drop=True))
+
+def make_dimension(n_provs, months):
+    """risk_dimension：(字段名, 编码, 名称)"""
+
+    dct = {'PROV_CD':{int(x):('厦门' if x == '3502' else '省市' + x) for x in _provinces(n_provs)},
+           'STAGE':{i + 1:'阶段{0}:{1},{2}'.format(i + 1, x.strftime('%Y/%m/%d'), '2099/12/31')
+                    for i, x in enumerate(_stage_breaks(months))},
+           'NEW_LOAN':{0:'存量贷款', 1:'新增贷款'},
+           'AIPMCHTTYPE':{1:'产品一', 2:'产品二', 3:'产品三'},
+           'LIGHT':{1:'红', 2:'黄', 3:'绿'}}
+    for col in ['OVERDUE_STATUS_3', 'OVERDUE_STATUS_3_LAST']:
+        dct[col] = {0:'非逾期', 1:'逾期', 2:'结清'}
+    for col in ['OVERDUE_STATUS_5', 'OVERDUE_STATUS_5_LAST']:
+        dct[col] = {1:'一般', 2:'催收', 3:'严重'}
+    for col in ['STATUS_LAST_MONTH', 'STATUS_THIS_MONTH']:
+        dct[col] = {1:'活动状态(active)', 2:'终止(terminate)'}
+
+    return(pd.DataFrame([(x, y, z) for x, codes in dct.items() for y, z in codes.items()], columns=['dimension', 'code', 'name']))
+
+def make_data(n_loans, n_months, n_provs, seed=0):
+    """合成月末数据（已按schema压缩）及维度表"""
+
+    months = _months(n_months)
+    loans = make_loans(n_loans, months, n_provs, seed)
+    db_data = datastore.concat(datastore._apply_schema(snapshot(loans, dt, seed), datastore.SCHEMA) for dt in months)
+
+    return(db_data, make_dimension(n_provs, months))
+
+def fake_oracle(path, n_loans, n_months, n_provs, seed=0):
+    """SQLite替身库：thbl.risk_statistics_all已有前n_months-1个月，RISK_STAT_MONTH由替身过程生成
+
+    返回(engine, procedure, dt_begin)，procedure可传入templateBisRpt.main及MonthStore.refresh。
+    """
+
+    os.makedirs(path, exist_ok=True)
+    engine = create_engine('sqlite:///' + os.path.join(path, 'oracle.db'), connect_args={'timeout':60})
+
+    @event.listens_for(engine, 'connect')
+    def _attach(dbapi_conn, record):
+        dbapi_conn.execute("attach database '{0}' as thbl".format(os.path.join(path, 'thbl.db')))
+
+    months = _months(n_months)
+    loans = make_loans(n_loans, months, n_provs, seed)
+
+    def procedure(conn, dt):
+        conn.execute(text('delete from thbl.risk_statistics_all where data_dt = :data_dt').bindparams(
+                bindparam('data_dt', type_=DateTime)), {'data_dt':pd.Timestamp(dt).to_pydatetime()})
+        snapshot(loans, dt, seed).to_sql('risk_statistics_all', conn, schema='thbl', if_exists='append', index=False)
+
+    make_dimension(n_provs, months).to_sql('risk_dimension', engine, if_exists='replace', index=False)
+    with engine.begin() as conn:
+        snapshot(loans, months[0], seed).head(0).to_sql('risk_statistics_all', conn, schema='thbl', if_exists='replace', index=False)
+    # 最近一个月留给main通过替身过程补算
+    for dt in months[:-1]:
+        with engine.begin() as conn:
+            procedure(conn, dt)
+
+    return(engine, procedure, months[0])
+
+def _cases(db_data, dct_dimension):
+    """基准用例：{名称:无参函数}"""
+
+    dct_col = rpt.DCT_COL
+    pivot = db_data.pivot_table(values='od_amt', index='begin_date', columns='data_dt', aggfunc='sum', observed=True)
+    dt_start = db_data.begin_date.min()
+
+    return({'_patch':lambda: rpt._patch(pivot, dt_start),
+            'cube':lambda: [rpt.cube(db_data, ['light'] + x) for x in rpt._CUBE_FAMILIES.values()],
+            'report_sheets':lambda: list(rpt.report_sheets(db_data, dct_dimension, dct_col, 'light')),
+            'report_sheets_detail':lambda: list(rpt.report_sheets(db_data, dct_dimension, dct_col, 'light', use_cube=False)),
+            'overdue':lambda: rpt.overdue(db_data, dct_dimension, dct_col, ['data_dt'], ['loan_pr_scope'], ['prov_cd']),
+            'overdue_toukong':lambda: rpt.overdue_toukong(db_data, dct_dimension, dct_col, ['data_dt']),
+            'status_trans':lambda: rpt.status_trans(db_data, dct_dimension, dct_col, ['light', 'data_dt'],
+                                                    ['cnt', 'od_amt'], ['cnt', 'diff_od_amt']),
+            'vintage':lambda: rpt.vintage(db_data, dct_dimension, dct_col, ['light', 'begin_date']),
+            'vintage_ex':lambda: rpt.vintage_ex(db_data, dct_dimension, dct_col, ['light', 'begin_date'], ['3502']),
+            'vintage_toukong':lambda: rpt.vintage_toukong(db_data, dct_dimension, dct_col, ['begin_date']),
+            'reloan':lambda: rpt.reloan(db_data, dct_dimension, dct_col, ['data_dt'], ['begin_date'])})
+
+def measure(func, repeat=3):
+    """耗时取repeat次最小值，内存峰值另行单独运行一次测量"""
+
+    seconds = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return({'seconds':min(seconds), 'peak_mb':peak / 2 ** 20})
+
+def run(sizes, repeat=3, e2e=False, seed=0):
+    """按规模运行全部用例，返回{规模:{用例:{'seconds', 'peak_mb'}}}"""
+
+    results = {}
+    for size in sizes:
+        n_loans, n_months, n_provs = SIZES[size]
+        db_data, db_dimension = make_data(n_loans, n_months, n_provs, seed)
+        dct_dimension = datastore.build_dimension(db_dimension)
+        print('规模{0}：{1}行'.format(size, len(db_data)))
+
+        results[size] = {}
+        for name, func in _cases(db_data, dct_dimension).items():
+            results[size][name] = measure(func, repeat)
+            print('  {0}：{1[seconds]:.3f}秒，峰值{1[peak_mb]:.1f}MB'.format(name, results[size][name]))
+
+        if e2e:
+            results[size]['main'] = {'seconds':run_main(n_loans, n_months, n_provs, seed), 'peak_mb':None}
+            print('  main：{0:.3f}秒'.format(results[size]['main']['seconds']))
+
+    return(results)
+
+def run_main(n_loans, n_months, n_provs, seed=0, n_jobs=None):
+    """在临时目录中以替身库运行完整报表流程，返回耗时（不含建库）"""
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as path:
+        engine, procedure, dt_begin = fake_oracle(os.path.join(path, 'db'), n_loans, n_months, n_provs, seed)
+        os.chdir(path)
+        try:
+            start = time.perf_counter()
+            rpt.main(engine, dt_begin=dt_begin, procedure=procedure, n_jobs=n_jobs)
+            return(time.perf_counter() - start)
+        finally:
+            os.chdir(cwd)
+            engine.dispose()
+
+def compare(results, baseline, tolerance=0.25):
+    """与基准比较，返回比较表及是否退化"""
+
+    rows = []
+    for size, cases in results.items():
+        for name, value in cases.items():
+            base = baseline.get(size, {}).get(name, {})
+            row = {'规模':size, '用例':name, '耗时':value['seconds'], '基准耗时':base.get('seconds'),
+                   '峰值MB':value['peak_mb'], '基准峰值MB':base.get('peak_mb')}
+            row['退化'] = any(row[x] is not None and row[y] is not None and row[x] > row[y] * (1 + tolerance)
+                             for x, y in [('耗时', '基准耗时'), ('峰值MB', '基准峰值MB')])
+            rows.append(row)
+    table = pd.DataFrame(rows)
+
+    return(table, bool(table['退化'].any()) if len(table) else False)
+
+#%%
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='报表函数性能基准')
+    parser.add_argument('--sizes', default='small,medium', help='规模，逗号分隔：' + ','.join(SIZES))
+    parser.add_argument('--repeat', type=int, default=3, help='计时重复次数')
+    parser.add_argument('--baseline', default='bench_baseline.json', help='基准文件')
+    parser.add_argument('--save', action='store_true', help='保存本次结果为基准')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='超过基准的比例视为退化')
+    parser.add_argument('--e2e', action='store_true', help='以SQLite替身库运行完整流程')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    results = run(args.sizes.split(','), args.repeat, args.e2e, args.seed)
+
+    if args.save:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        for size, cases in results.items():
+            baseline.setdefault(size, {}).update(cases)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print('已保存基准：' + args.baseline)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            table, regressed = compare(results, json.load(f), args.tolerance)
+        with pd.option_context('display.width', 200, 'display.max_rows', None):
+            print(table.to_string(index=False, float_format='{0:.3f}'.format))
+        sys.exit(1 if regressed else 0)
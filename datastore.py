@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import datetime
+import os
+import pickle
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import DateTime, bindparam, create_engine, text
+
+from instrument import stage
+
+# 字段类型：维度和状态码转为分类，计数和天数压缩为最小整数，金额保持float64保证汇总精度
+SCHEMA = {'category':['prov_cd', 'stage', 'aipmchttype', 'loan_period_mon', 'repay_period', 'white', 'applysource',
+                      'reloantimes', 'light', 'loan_pr_scope', 'new_loan', 'overdue_status_3', 'overdue_status_5',
+                      'overdue_status_3_last', 'overdue_status_5_last', 'status_last_month', 'status_this_month'],
+          'integer':['cnt', 'maturity_days', 'new_maturity_days', 'reloan']}
+
+# 连接池：各脚本共用，大小须不小于并发查询数
+POOL = {'pool_size':8, 'max_overflow':4, 'pool_pre_ping':True}
+
+# 各数据库的连接参数，连接串取config.ConfigDevelopment.DB_<名称>
+CONNECT_ARGS = {'oracle':{'encoding':'utf8', 'nencoding':'utf8'},
+                'mysql':{'charset':'utf8'}}
+
+_ENGINES = {}
+_ENGINES_LOCK = threading.Lock()
+
+# 维度字典缓存版本：字典结构或构建方式变化时加1，使旧缓存失效
+DIMENSION_VERSION = 1
+
+def _apply_schema(data, schema):
+    """按schema压缩字段类型"""
+
+    for col in schema.get('category', []):
+        if col in data.columns:
+            data[col] = data[col].astype('category').cat.as_ordered() # 有序分类，分组结果按编码排序
+    for col in schema.get('integer', []):
+        if col in data.columns:
+            data[col] = pd.to_numeric(data[col], downcast='integer')
+
+    return(data)
+
+def concat(dfs):
+    """合并数据块，分类字段先统一类别，避免合并后退化为object
+
+    dfs为迭代器时逐块取出：每块拆为各字段独立的副本后即可释放，再逐个字段合并并释放该字段的各块。
+    按块整体合并时全部数据块与结果同时存在，峰值为数据的两倍；逐字段合并只多出读入中的数据块及其副本，或一个字段，取较大者。
+    """
+
+    # 同一数据块的字段共用内存，只删去个别字段不能释放，须逐字段复制
+    parts = [(len(x), {col:x[col].copy() for col in x.columns}) for x in dfs]
+    if not parts:
+        return(pd.DataFrame())
+
+    data = {}
+    for col in dict.fromkeys(col for _, x in parts for col in x):
+        # 缺少该字段的数据块补空值，与按块整体合并一致
+        lst = [x.pop(col) if col in x else pd.Series(np.nan, index=pd.RangeIndex(n)) for n, x in parts]
+        if all(isinstance(x.dtype, pd.CategoricalDtype) for x in lst):
+            categories = lst[0].cat.categories
+            for x in lst[1:]:
+                categories = categories.union(x.cat.categories)
+            lst = [x.cat.set_categories(categories) for x in lst]
+        data[col] = pd.concat(lst, ignore_index=True)
+        del lst
+
+    return(pd.DataFrame(data, copy=False))
+
+def get_engine(name='oracle'):
+    """共享的连接池：同一数据库只建一个engine，各线程及脚本共用"""
+
+    with _ENGINES_LOCK:
+        if name not in _ENGINES:
+            import config
+            _ENGINES[name] = create_engine(getattr(config.ConfigDevelopment, 'DB_' + name.upper())['str'],
+                                           connect_args=CONNECT_ARGS.get(name, {}), **POOL)
+
+    return(_ENGINES[name])
+
+def run_parallel(tasks, n_jobs=4):
+    """并发执行相互独立的查询：tasks为{名称:(函数, 参数)}，返回{名称:结果}
+
+    查询等待数据库期间不占用GIL，线程即可并行；任一查询失败时抛出其异常。
+    """
+
+    with ThreadPoolExecutor(max_workers=max(1, min(n_jobs, len(tasks)))) as pool:
+        futures = {key:pool.submit(func, *args) for key, (func, args) in tasks.items()}
+        return({key:future.result() for key, future in futures.items()})
+
+def read_chunks(sql, engine, params=None, chunksize=100000, parse_dates=None):
+    """服务端游标分块读取，驱动不缓存整个结果集；字段名统一为小写，parse_dates按小写字段名转为日期"""
+
+    with engine.connect().execution_options(stream_results=True) as conn:
+        for x in pd.read_sql(sql, conn, params=params, chunksize=chunksize):
+            x.columns = x.columns.str.lower()
+            for col in parse_dates or []:
+                x[col] = pd.to_datetime(x[col])
+            yield x
+
+def prefetch(chunks, depth=2):
+    """后台线程预读数据块，读取与消费并行；最多缓存depth块
+
+    消费方提前结束时通知后台线程停止，并在后台线程中关闭数据块迭代器以释放连接。
+    """
+
+    items, stop, end = queue.Queue(depth), threading.Event(), object()
+
+    def _put(x):
+        while not stop.is_set():
+            try:
+                items.put(x, timeout=0.1)
+                return(True)
+            except queue.Full:
+                pass
+        return(False)
+
+    def _worker():
+        it = iter(chunks)
+        try:
+            for x in it:
+                if not _put(x):
+                    break
+            else:
+                _put(end)
+        except Exception as e:
+            _put(e)
+        finally:
+            if hasattr(it, 'close'):
+                it.close()
+
+    threading.Thread(target=_worker, daemon=True).start()
+    try:
+        while True:
+            x = items.get()
+            if x is end:
+                return
+            if isinstance(x, Exception):
+                raise x
+            yield x
+    finally:
+        stop.set()
+
+def read_sql(sql, engine, params=None, parse_dates=None, schema=SCHEMA, chunksize=100000):
+    """分块读取查询结果，逐块压缩字段类型后逐个交给concat合并"""
+
+    def _chunks():
+        # 拉取字节数按压缩前数据块的内存计
+        for x in read_chunks(sql, engine, params, chunksize, parse_dates):
+            rec['bytes'] += int(x.memory_usage(deep=True).sum())
+            yield _apply_schema(x, schema)
+
+    with stage('read_sql') as rec:
+        rec['bytes'] = 0
+        data = concat(_chunks())
+        rec['rows_out'] = len(data)
+
+    return(data)
+
+# 汇总条件运算符对应的SQL，不等于另含空值，与pandas口径一致
+_SQL_OPS = {'==':'{0} = :{1}', '!=':'({0} <> :{1} or {0} is null)', '>':'{0} > :{1}', '>=':'{0} >= :{1}',
+            '<':'{0} < :{1}', '<=':'{0} <= :{1}'}
+
+def call_risk_stat_month(conn, dt):
+    """调用存储过程重算单月快照，日期以绑定参数传入"""
+    conn.execute(text('call RISK_STAT_MONTH(:data_dt, 0)'), {'data_dt':pd.Timestamp(dt).strftime('%Y%m%d')})
+
+class RefreshError(RuntimeError):
+    """重算快照失败：failed为{月份:异常信息}，refreshed为同批成功重算的月份"""
+
+    def __init__(self, failed, refreshed):
+        self.failed = failed
+        self.refreshed = refreshed
+        super().__init__('重算快照失败：' + '，'.join(x.strftime('%F') for x in sorted(failed)))
+
+class MonthStore(object):
+    """按data_dt分区的本地快照库
+
+    已缓存的月份直接读本地parquet，只向数据库请求缺失或重算的月份，n_jobs个月份并行拉取。
+    engine和table可替换为本地SQLite等替身库。
+    """
+
+    def __init__(self, engine, path='cache/risk_statistics_all', table='thbl.risk_statistics_all',
+                 parse_dates=('data_dt', 'begin_date'), schema=SCHEMA, n_jobs=4):
+        self.engine = engine
+        self.path = path
+        self.table = table
+        self.parse_dates = list(parse_dates)
+        self.schema = schema
+        self.n_jobs = n_jobs
+        self._remote = None
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, dt):
+        """分区文件路径"""
+        return(os.path.join(self.path, 'data_dt=' + pd.Timestamp(dt).strftime('%Y%m%d') + '.parquet'))
+
+    def cached(self):
+        """本地已缓存的月份"""
+        return(set(pd.Timestamp(x[8:16]) for x in os.listdir(self.path)
+                   if x.startswith('data_dt=') and x.endswith('.parquet')))
+
+    def remote(self, reload=False):
+        """数据库中已有的月份：只查询一次，refresh成功的月份随之并入"""
+        if self._remote is None or reload:
+            db_data_dt = pd.read_sql(text('select distinct data_dt from ' + self.table), self.engine)
+            self._remote = set(pd.to_datetime(db_data_dt.data_dt))
+        return(set(self._remote))
+
+    def refresh(self, lst_dt, force=False, procedure=call_risk_stat_month, n_jobs=4, retries=2, wait=10):
+        """重算快照：默认只算数据库中缺失的月份，force为真时全部重算
+
+        每个月份单独开连接和事务，失败重试retries次，不影响其他月份。
+        并发数n_jobs不应超过engine连接池大小；procedure(conn, dt)可替换为本地替身。
+        成功重算的月份随即删除本地分区，之后读取时重新拉取，即使其他月份失败也不会沿用旧分区。
+        返回成功重算的月份；全部月份算完后仍有失败的，抛出RefreshError列出失败月份，
+        以免报表缺月或沿用旧快照。
+        """
+
+        lst_dt = [pd.Timestamp(x) for x in lst_dt]
+        if not force:
+            remote = self.remote()
+            lst_dt = [x for x in lst_dt if x not in remote]
+        if not lst_dt:
+            return([])
+
+        def _run(dt):
+            for i in range(retries + 1):
+                try:
+                    with stage('RISK_STAT_MONTH', data_dt=dt.strftime('%F'), attempt=i+1), self.engine.begin() as conn:
+                        procedure(conn, dt)
+                    return(None)
+                except Exception:
+                    if i == retries:
+                        return(traceback.format_exc())
+                    time.sleep(wait * 2 ** i)
+
+        refreshed, failed = [], {}
+        with ThreadPoolExecutor(max_workers=max(1, min(n_jobs, len(lst_dt)))) as pool:
+            futures = {pool.submit(_run, dt):dt for dt in lst_dt}
+            for n, future in enumerate(as_completed(futures), 1):
+                dt, error = futures[future], future.result()
+                print('重算快照[{0}/{1}]：'.format(n, len(lst_dt)) + dt.strftime('%F') + ('，失败\n' + error if error else '，完成'))
+                if error is None:
+                    self.invalidate(dt)
+                    refreshed.append(dt)
+                else:
+                    failed[dt] = error
+
+        if self._remote is not None:
+            self._remote.update(refreshed)
+        if failed:
+            raise RefreshError(failed, sorted(refreshed))
+
+        return(sorted(refreshed))
+
+    def invalidate(self, dt):
+        """删除重算月份的本地分区"""
+        if os.path.exists(self._file(dt)):
+            os.remove(self._file(dt))
+
+    def fetch(self, dt):
+        """从数据库拉取单月数据并写入本地分区"""
+        sql = text('select * from ' + self.table + ' where data_dt = :data_dt').bindparams(
+                bindparam('data_dt', type_=DateTime))
+        with stage('fetch', data_dt=pd.Timestamp(dt).strftime('%F')) as rec:
+            data = read_sql(sql, self.engine, params={'data_dt':pd.Timestamp(dt).to_pydatetime()},
+                            parse_dates=self.parse_dates, schema=self.schema)
+            rec['rows_out'] = len(data)
+
+            # 先写临时文件再替换，避免中断后留下不完整的分区
+            data.to_parquet(self._file(dt) + '.tmp', index=False)
+            os.replace(self._file(dt) + '.tmp', self._file(dt))
+
+        return(data)
+
+    def load(self, lst_dt):
+        """读取指定月份数据：本地缺失（含refresh重算后失效）的月份从数据库拉取"""
+
+        with stage('load', months=len(lst_dt)) as rec:
+            # 只拉取本地缺失且数据库中存在的月份
+            cached = self.cached()
+            missing = [dt for dt in lst_dt if pd.Timestamp(dt) not in cached]
+            if missing:
+                remote = self.remote()
+                missing = [dt for dt in missing if pd.Timestamp(dt) in remote]
+            if missing:
+                # 各月份分区并行拉取
+                with ThreadPoolExecutor(max_workers=max(1, min(self.n_jobs, len(missing)))) as pool:
+                    futures = {pool.submit(self.fetch, dt):dt for dt in missing}
+                    for future in as_completed(futures):
+                        future.result()
+                        print('拉取月份数据：' + pd.Timestamp(futures[future]).strftime('%F'))
+
+            # parquet不保留数值型分类字段，读取后按schema还原；各月份分区逐个交给concat
+            data = concat(_apply_schema(pd.read_parquet(self._file(dt)), self.schema)
+                          for dt in lst_dt if os.path.exists(self._file(dt)))
+            rec['rows_out'] = len(data)
+
+        return(data)
+
+class SqlTable(object):
+    """数据库中的明细表，汇总下推为GROUP BY查询，只返回汇总结果
+
+    where为[(字段, 运算符, 值), ...]，限定参与汇总的数据范围，如周四快照。
+    """
+
+    def __init__(self, engine, table='thbl.risk_statistics_all', where=(), parse_dates=('data_dt', 'begin_date'),
+                 schema=SCHEMA):
+        self.engine = engine
+        self.table = table
+        self.where = list(where)
+        self.parse_dates = list(parse_dates)
+        self.schema = schema
+
+    def _cond(self, cond, params):
+        """条件转为SQL，取值作为绑定参数"""
+
+        sql = []
+        for col, op, value in cond:
+            name = 'p{0}'.format(len(params))
+            if isinstance(value, (pd.Timestamp, np.datetime64)):
+                value = pd.Timestamp(value).to_pydatetime()
+            params[name] = value
+            sql.append(_SQL_OPS[op].format(col, name))
+
+        return(' and '.join(sql))
+
+    def _bind(self, sql, params):
+        """日期参数按DateTime绑定"""
+        return(text(sql).bindparams(*[bindparam(x, type_=DateTime) for x, y in params.items()
+                                      if isinstance(y, datetime.datetime)]))
+
+    def max(self, col):
+        """字段最大值"""
+
+        params = {}
+        where = self._cond(self.where, params)
+        sql = 'select max({0}) as value from {1}'.format(col, self.table) + (' where ' + where if where else '')
+        value = pd.read_sql(self._bind(sql, params), self.engine, params=params).iloc[0, 0]
+
+        return(pd.Timestamp(value) if col in self.parse_dates else value)
+
+    def agg(self, gp_keys, specs, where=()):
+        """分组条件汇总，口径同templateBisRpt._agg
+
+        每个条件的求和转为SUM(CASE WHEN ...)列；各条件都非空时只保留满足任一条件的行，
+        与pandas只保留命中分组的结果一致。分组字段为空的行不参与分组。
+        """
+
+        params = {}
+        columns, names = [], {}
+        conds = [self._cond(cond, params) for cond, _ in specs]
+        for cond, (_, dct) in zip(conds, specs):
+            for col, name in dct.items():
+                names['v{0}'.format(len(names))] = name
+                columns.append('coalesce(sum(' + ('case when {0} then {1} end'.format(cond, col) if cond else col) +
+                               '), 0) as v{0}'.format(len(names)-1))
+
+        where = [self._cond(self.where + list(where), params)] + ['{0} is not null'.format(x) for x in gp_keys]
+        if all(conds):
+            where.append('(' + ' or '.join('(' + x + ')' for x in conds) + ')')
+
+        sql = ('select ' + ', '.join(list(gp_keys) + columns) + ' from ' + self.table +
+               ' where ' + ' and '.join(x for x in where if x) + 
+               ' group by ' + ', '.join(gp_keys) + ' order by ' + ', '.join(gp_keys))
+        with stage('sql_agg') as rec:
+            result = pd.read_sql(self._bind(sql, params), self.engine, params=params,
+                                 parse_dates=[x for x in gp_keys if x in self.parse_dates])
+            rec['rows_out'] = len(result)
+
+        return(_apply_schema(result, self.schema).set_index(list(gp_keys)).rename(columns=names))
+
+def build_dimension(db_dimension):
+    """由risk_dimension构建维度字典{字段名:{编码:名称}}"""
+
+    names = db_dimension.iloc[:, 0].str.lower()
+    dct_dimension = {name:dict(zip(grp.iloc[:, 1], grp.iloc[:, 2])) for name, grp in db_dimension.groupby(names, sort=False)}
+
+    # 省市在stat_all里是字符，在dimension里是数字
+    if 'prov_cd' in dct_dimension:
+        dct_dimension['prov_cd'] = {str(x):y for x,y in dct_dimension['prov_cd'].items()}
+
+    return(dct_dimension)
+
+def load_dimension(engine, path='cache/risk_dimension.pkl', ttl=pd.Timedelta(days=1)):
+    """读取维度字典：本地缓存版本一致且未超过ttl时直接使用，否则从数据库重建"""
+
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            cache = pickle.load(f)
+        if cache['version'] == DIMENSION_VERSION and pd.Timestamp.now() - cache['built'] < ttl:
+            return(cache['dct_dimension'])
+
+    with stage('load_dimension'):
+        dct_dimension = build_dimension(pd.read_sql(text('select * from risk_dimension'), engine))
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump({'version':DIMENSION_VERSION, 'built':pd.Timestamp.now(), 'dct_dimension':dct_dimension}, f)
+    os.replace(path + '.tmp', path)
+
+    return(dct_dimension)
@@ -1,29 +1,163 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import json
+import os
+
 import pandas as pd
-import xlwings as xw
-from sqlalchemy import create_engine
+from sqlalchemy import DateTime, bindparam, text
+
+from datastore import get_engine, prefetch, read_chunks
+from instrument import stage
+
+# 借据号：TM_LOAN与S6700按此字段关联，两库中类型须一致（数值或ASCII编码字符），保证排序一致
+KEY = 'loan_id'
+
+# 未结清的MCEI借据，借据号随放款递增，只需从首期逾期借据号的下限读起
+SQL_LOAN = "SELECT * FROM `TM_LOAN` WHERE LOAN_TYPE='MCEI' and PAID_OUT_DATE=0 and LOAN_ID >= :min_key ORDER BY LOAN_ID"
+# S6700中当前期数为1且逾期天数大于0视为首期逾期；待处理的快照日期一次查询
+SQL_S6700 = ('SELECT LOAN_ID, DATA_DT AS FLAG_DT, CURR_TERM, OVERDUE_DAYS FROM S6700 '
+             'WHERE DATA_DT IN :data_dt and CURR_TERM = 1 and OVERDUE_DAYS > 0 ORDER BY LOAN_ID')
+SQL_S6700_MIN = 'SELECT MIN(LOAN_ID) FROM S6700 WHERE DATA_DT IN :data_dt and CURR_TERM = 1 and OVERDUE_DAYS > 0'
+
+def merge_join(left, right, key=KEY, **kwargs):
+    """两个按key升序的数据块流做归并内连接，逐块返回连接结果
+
+    两侧未读完的缓冲中尾键的较小者为界，小于界的键在两侧均已读全，可以先行连接；
+    等于界的键可能延续到下一块，留在缓冲中；两侧都读完后全部连接。
+    缓冲只保留未确定的尾部，内存与数据块大小相当。kwargs传给pd.merge。
+    """
+
+    streams = [iter(left), iter(right)]
+    buffers = [pd.DataFrame(), pd.DataFrame()]
+    done, tails = [False, False], [None, None]
+
+    while not all(done):
+        # 缓冲为空的一侧先读，否则读尾键较小的一侧
+        pending = [i for i in range(2) if not done[i]]
+        empty = [i for i in pending if not len(buffers[i])]
+        i = empty[0] if empty else min(pending, key=lambda j: buffers[j][key].iloc[-1])
+
+        chunk = next(streams[i], None)
+        if chunk is None:
+            done[i] = True
+        elif len(chunk):
+            keys = chunk[key].values
+            if (tails[i] is not None and keys[0] < tails[i]) or (keys[1:] < keys[:-1]).any():
+                raise ValueError('数据未按{0}升序排列'.format(key))
+            tails[i] = keys[-1]
+            buffers[i] = pd.concat([buffers[i], chunk], ignore_index=True) if len(buffers[i]) else chunk
+
+        # 一侧读完且缓冲为空，另一侧不会再有匹配
+        if any(done[j] and not len(buffers[j]) for j in range(2)):
+            return
+        if not all(len(x) for x in buffers):
+            continue
+
+        if all(done):
+            parts, buffers = buffers, [buffers[0].iloc[:0], buffers[1].iloc[:0]]
+        else:
+            bound = min(buffers[j][key].iloc[-1] for j in range(2) if not done[j])
+            masks = [x[key].values < bound for x in buffers]
+            parts = [x[m] for x, m in zip(buffers, masks)]
+            buffers = [x[~m].reset_index(drop=True) for x, m in zip(buffers, masks)]
+
+        if len(parts[0]) and len(parts[1]):
+            result = pd.merge(parts[0], parts[1], on=key, **kwargs)
+            if len(result):
+                yield result
+
+def _date(dt):
+    """日期绑定参数，dt为列表时绑定日期列表"""
+    if isinstance(dt, (list, tuple)):
+        return({'data_dt':[pd.Timestamp(x).to_pydatetime() for x in dt]})
+    return({'data_dt':pd.Timestamp(dt).to_pydatetime()})
 
-import config
+def _bind(sql):
+    """日期按DateTime绑定，IN :data_dt展开为日期列表"""
+    return(text(sql).bindparams(bindparam('data_dt', type_=DateTime, expanding=' IN :data_dt' in sql)))
+
+def _partition(path, dt):
+    """标记结果的日期分区文件"""
+    return(os.path.join(path, 'data_dt=' + pd.Timestamp(dt).strftime('%Y%m%d') + '.parquet'))
 
 # 首次逾期
-def 首期逾期():
-    pass
+def 首期逾期(engine_mysql, engine_oracle, lst_dt, path='cache/首期逾期', chunksize=100000):
+    """首期逾期：S6700各日快照中首期即逾期的借据，关联TM_LOAN中未结清的MCEI借据
+
+    待处理的日期一次查询S6700，与TM_LOAN均按借据号有序分块并行读取，归并连接；TM_LOAN每次运行只读一遍，
+    内存只保留少数数据块。
+    增量运行：已处理的快照日期跳过，已标记过的借据不重复输出；标记结果按首次标记的日期追加分区文件，
+    分区写完后再记日期，中断后重跑时覆盖未记入状态的分区。
+    返回本次新标记的借据，data_dt为首次标记的快照日期。
+    """
+
+    os.makedirs(path, exist_ok=True)
+    file_state = os.path.join(path, 'state.json')
+
+    state = {'dates':[]}
+    if os.path.exists(file_state):
+        with open(file_state) as f:
+            state = json.load(f)
+
+    lst_new = sorted(set(pd.to_datetime(lst_dt)) - set(pd.to_datetime(state['dates'])))
+    if not lst_new:
+        return(pd.DataFrame(columns=[KEY, 'data_dt']))
+
+    # 已标记的借据：本次待处理日期的分区除外
+    flagged_keys = set()
+    for x in sorted(os.listdir(path)):
+        if x.startswith('data_dt=') and x.endswith('.parquet') and pd.Timestamp(x[8:16]) not in lst_new:
+            flagged_keys.update(pd.read_parquet(os.path.join(path, x), columns=[KEY])[KEY])
+
+    with stage('首期逾期', data_dt=','.join(x.strftime('%F') for x in lst_new)) as rec:
+        # 首期逾期借据号的下限，转为Python类型作为绑定参数
+        min_key = pd.read_sql(_bind(SQL_S6700_MIN), engine_oracle, params=_date(lst_new)).iloc[:, 0].tolist()[0]
+
+        dfs = []
+        if min_key is not None and not pd.isnull(min_key):
+            # 两库各由后台线程预读，读取与连接并行
+            loans = prefetch(read_chunks(text(SQL_LOAN), engine_mysql, {'min_key':min_key}, chunksize))
+            s6700 = prefetch(read_chunks(_bind(SQL_S6700), engine_oracle, _date(lst_new), chunksize, ['flag_dt']))
+            for x in merge_join(loans, s6700, KEY, suffixes=('', '_s6700')):
+                dfs.append(x[~x[KEY].isin(flagged_keys)])
+
+        result = pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame(columns=[KEY, 'flag_dt'])
+        # 多个日期首期逾期的借据记在最早的日期
+        result = result.sort_values(['flag_dt', KEY], kind='mergesort').drop_duplicates(KEY).reset_index(drop=True)
+        result['data_dt'] = pd.to_datetime(result.pop('flag_dt'))
+        rec['rows_out'] = len(result)
+
+        # 保存状态：先写各日期分区再记日期，中断后重跑不会漏标
+        for dt in lst_new:
+            part = result[result.data_dt == dt]
+            if len(part):
+                part.to_parquet(_partition(path, dt) + '.tmp', index=False)
+                os.replace(_partition(path, dt) + '.tmp', _partition(path, dt))
+            elif os.path.exists(_partition(path, dt)):
+                os.remove(_partition(path, dt))
+            print('首期逾期：' + dt.strftime('%F') + '，新标记{0}笔'.format(len(part)))
+
+        state['dates'] = sorted(set(state['dates']) | {x.strftime('%F') for x in lst_new})
+        with open(file_state + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(file_state + '.tmp', file_state)
+
+    return(result)
 
 #%%
 if __name__=='__main__':
+    from workbook import write_excel
 
-    # 连接数据库
-    engine_oracle = create_engine(config.ConfigDevelopment.DB_ORACLE['str'], 
-                                  connect_args={'encoding':'utf8', 'nencoding':'utf8'})
-    engine_mysql = create_engine(config.ConfigDevelopment.DB_MYSQL['str'], 
-                             connect_args={'charset':'utf8'})
-
-    # 获取数据
-    data1 = pd.read_sql("SELECT * FROM `TM_LOAN` WHERE LOAN_TYPE='MCEI' and PAID_OUT_DATE=0", engine_mysql)
-    
-    data2 = pd.read_sql("SELECT * FROM S6700 WHERE DATA_DT=TO_DATE(20180222, 'yyyymmdd')", engine_oracle)
-    
+    # 连接数据库：共享连接池
+    engine_oracle = get_engine('oracle')
+    engine_mysql = get_engine('mysql')
 
+    # 近一周已生成的快照，漏跑的日期一并补算
+    lst_dt = pd.read_sql(_bind('SELECT DISTINCT DATA_DT FROM S6700 WHERE DATA_DT >= :data_dt'), engine_oracle,
+                         params=_date(pd.Timestamp.today().normalize() - pd.Timedelta(days=7))).iloc[:, 0]
 
+    data = 首期逾期(engine_mysql, engine_oracle, lst_dt)
+    if len(data):
+        write_excel('首期逾期_' + pd.Timestamp.today().strftime('%Y%m%d') + '.xlsx', [(data.set_index(KEY), '首期逾期', 0, 0)],
+                    'yyyy-mm-dd')
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""报表流程各阶段的耗时和内存记录
+
+    with stage('fetch', data_dt='2018-01-31') as rec:
+        data = ...
+        rec['rows_out'] = len(data)
+
+每个阶段记录墙钟时间、CPU时间、峰值RSS增量、输入输出行数及拉取字节数，
+阶段名按嵌套关系记为路径，如“套表/省市/vintage”。dump()把本次运行的记录输出为JSON；
+configure(profile=阶段名或路径)时另把该阶段的cProfile结果保存为.prof文件。
+
+cpu为阶段所在线程的CPU时间，不含同时运行的其他线程；cpu_process为整个进程的CPU时间，
+阶段内开线程池并发执行时以此为准。rss_peak_delta为进程峰值RSS（高水位）在阶段内的增量：
+阶段开始前已达到的峰值不再计入，只有阶段把峰值推高时为正，为0不代表阶段没有分配内存；
+峰值为进程级，同时运行的其他线程的分配也计入。
+"""
+
+import cProfile
+import functools
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError: # Windows没有resource，不记录RSS
+    resource = None
+
+# 本次运行的记录及配置
+_RUN = {'started':pd.Timestamp.now(), 'records':[], 'profile':None, 'profile_dir':'.', 'profiling':False}
+_LOCK = threading.Lock()
+
+# 各线程的阶段栈
+_LOCAL = threading.local()
+
+def configure(profile=None, profile_dir='.'):
+    """开始新的一次运行：清空记录，profile为需要cProfile的阶段名或路径"""
+
+    with _LOCK:
+        _RUN.update({'started':pd.Timestamp.now(), 'records':[], 'profile':profile, 'profile_dir':profile_dir,
+                     'profiling':False})
+
+@contextmanager
+def recording(enabled):
+    """当前线程内开启或关闭阶段记录，退出时恢复；不影响其他线程
+
+    常驻服务中查询不断，查询期间关闭记录以免无限累积。
+    """
+
+    previous = getattr(_LOCAL, 'record', True)
+    _LOCAL.record = enabled
+    try:
+        yield
+    finally:
+        _LOCAL.record = previous
+
+def _max_rss():
+    """进程峰值RSS（字节）"""
+
+    if resource is None:
+        return(None)
+
+    # macOS单位为字节，Linux为KB
+    return(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024))
+
+def rows(obj):
+    """表的行数：列表、元组内的表累加，非表为0"""
+
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return(len(obj))
+    if isinstance(obj, (list, tuple)):
+        return(sum(rows(x) for x in obj))
+
+    return(0)
+
+@contextmanager
+def stage(name, **info):
+    """记录一个阶段，返回的字典可补充rows_in、rows_out、bytes等信息"""
+
+    stack = _LOCAL.__dict__.setdefault('stack', [])
+    path = '/'.join(stack + [name])
+    rec = dict({'stage':path, 'start':pd.Timestamp.now(), 'rows_in':None, 'rows_out':None, 'bytes':None}, **info)
+
+    # 同一时间只运行一个cProfile
+    profiler = None
+    with _LOCK:
+        if _RUN['profile'] in (name, path) and not _RUN['profiling']:
+            _RUN['profiling'], profiler = True, cProfile.Profile()
+
+    rss, wall, cpu, cpu_process = _max_rss(), time.perf_counter(), time.thread_time(), time.process_time()
+    stack.append(name)
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield rec
+    except BaseException:
+        rec['error'] = True
+        raise
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(_RUN['profile_dir'], exist_ok=True)
+            rec['profile'] = os.path.join(_RUN['profile_dir'], path.replace('/', '_') + '.prof')
+            profiler.dump_stats(rec['profile'])
+            _RUN['profiling'] = False
+        stack.pop()
+
+        rec.update({'wall':time.perf_counter() - wall, 'cpu':time.thread_time() - cpu,
+                    'cpu_process':time.process_time() - cpu_process,
+                    'rss_peak_delta':None if rss is None else _max_rss() - rss,
+                    'pid':os.getpid(), 'thread':threading.current_thread().name})
+        if getattr(_LOCAL, 'record', True):
+            with _LOCK:
+                _RUN['records'].append(rec)
+
+def staged(func):
+    """装饰报表函数：按函数名记录阶段，输入行数为参数中各表行数之和，输出行数为返回的各表行数之和"""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with stage(func.__name__) as rec:
+            rec['rows_in'] = rows(list(args))
+            result = func(*args, **kwargs)
+            rec['rows_out'] = rows(result)
+            return(result)
+
+    return(wrapper)
+
+def records():
+    """本次运行已有的记录"""
+
+    with _LOCK:
+        return(list(_RUN['records']))
+
+def extend(lst):
+    """并入子进程的记录"""
+
+    with _LOCK:
+        _RUN['records'].extend(lst)
+
+def dump(path):
+    """本次运行的记录输出为JSON"""
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    run = {'started':_RUN['started'], 'host':socket.gethostname(), 'pid':os.getpid(),
+           'records':sorted(records(), key=lambda x: x['start'])}
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(run, f, ensure_ascii=False, indent=1, default=str)
+    os.replace(path + '.tmp', path)
+
+    return(path)
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""报表查询服务：月末数据及维度字典常驻内存，按任意分组临时出表
+
+    python service.py --port 8050
+
+    curl 'http://127.0.0.1:8050/overdue?gp_keys_all=reloantimes,applysource,data_dt&gp_keys_last=reloantimes,applysource,loan_pr_scope'
+    curl 'http://127.0.0.1:8050/vintage?gp_keys_all=white,begin_date&where=prov_cd!=3502'
+    curl 'http://127.0.0.1:8050/vintage_ex?gp_keys_all=white,begin_date&ex_prov=3502'
+    curl -o 临时.xlsx 'http://127.0.0.1:8050/status_trans?index_values=white,data_dt&pivot_values_all=cnt,od_amt&pivot_values_trans=cnt,diff_od_amt&format=xlsx'
+    curl 'http://127.0.0.1:8050/reload'
+
+参数为报表函数的同名参数，多个字段用逗号分隔；where为过滤条件“字段运算符取值”，可重复，各条件取且。
+结果按(函数, 参数, 过滤条件, 数据版本)缓存，重新加载数据后版本改变，旧结果不再命中。
+"""
+
+import argparse
+import inspect
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+
+import instrument
+from datastore import MonthStore, get_engine, load_dimension, run_parallel
+from instrument import stage
+from templateBisRpt import DCT_COL, _mask, overdue, reloan, status_trans, vintage, vintage_ex
+from workbook import Workbook
+
+# 可查询的报表函数及其参数：(函数, {参数:类型})，list为逗号分隔的字段列表
+FUNCS = {'overdue':(overdue, {'gp_keys_all':list, 'gp_keys_last':list, 'gp_keys_prov':list}),
+         'vintage':(vintage, {'gp_keys_all':list, 'gp_value':str}),
+         'vintage_ex':(vintage_ex, {'gp_keys_all':list, 'ex_prov':list, 'gp_value':str}),
+         'status_trans':(status_trans, {'index_values':list, 'pivot_values_all':list, 'pivot_values_trans':list}),
+         'reloan':(reloan, {'gp_keys_mcd':list, 'gp_keys_db':list})}
+
+# 过滤条件：字段、运算符、取值
+_WHERE = re.compile(r'^(\w+)(==|!=|>=|<=|>|<)(.*)$')
+
+def _tables(result):
+    """报表函数的返回值展开为表的列表，空表跳过"""
+
+    if isinstance(result, (pd.DataFrame, pd.Series)):
+        return([result])
+    if isinstance(result, (list, tuple)):
+        return([y for x in result for y in _tables(x)])
+
+    return([])
+
+class ReportService(object):
+    """常驻内存的报表数据：月末明细及维度字典
+
+    查询直接汇总明细；结果按LRU缓存maxsize个。
+    """
+
+    def __init__(self, engine, dt_begin='20151101', store=None, maxsize=128):
+        self.engine = engine
+        self.dt_begin = dt_begin
+        self.store = store or MonthStore(engine)
+        self.maxsize = maxsize
+        self.version = None
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        """重新加载月末数据及维度字典，数据版本随之改变"""
+
+        with stage('reload') as rec:
+            lst_month = pd.date_range(self.dt_begin, pd.Timestamp.today(), freq=pd.offsets.MonthEnd())
+            loaded = run_parallel({'dimension':(load_dimension, (self.engine,)),
+                                   'month_end':(self.store.load, (lst_month,))})
+            db_month_end = loaded['month_end']
+            rec['rows_out'] = len(db_month_end)
+
+        with self._lock:
+            self.dct_dimension, self.db_month_end = loaded['dimension'], db_month_end
+            self.version = '{0}@{1}'.format(db_month_end.data_dt.max().strftime('%F') if len(db_month_end) else '',
+                                            pd.Timestamp.now().strftime('%F %T.%f'))
+            self._cache.clear()
+
+        print('数据已加载：{0}行，版本{1}'.format(len(db_month_end), self.version))
+
+        return(self.version)
+
+    def query(self, func, where=(), **kwargs):
+        """执行报表函数：where为[(字段, 运算符, 值), ...]，kwargs为报表函数的参数
+
+        返回(结果, 是否命中缓存)。数据版本、维度字典及数据在开始时一并取出，计算期间重新加载不影响本次查询。
+        """
+
+        if func not in FUNCS:
+            raise KeyError('未知的报表函数：' + func)
+        report, params = FUNCS[func]
+        unknown = set(kwargs) - set(params)
+        if unknown:
+            raise KeyError('{0}不支持参数：{1}'.format(func, ','.join(sorted(unknown))))
+        # 前三个参数为数据、维度字典及字段名，由服务传入
+        missing = [k for k, x in list(inspect.signature(report).parameters.items())[3:]
+                   if x.default is x.empty and k not in kwargs]
+        if missing:
+            raise KeyError('{0}缺少参数：{1}'.format(func, ','.join(missing)))
+
+        where = tuple(tuple(x) for x in where)
+        args = tuple(sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in kwargs.items()))
+        with self._lock:
+            version, dct_dimension, data = self.version, self.dct_dimension, self.db_month_end
+            key = (func, args, where, version)
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return(self._cache[key], True)
+
+        if where:
+            try:
+                data = data[_mask(data, where)]
+            except TypeError as e: # 取值与字段类型不可比较
+                raise ValueError('过滤条件的取值类型不符：{0}'.format(e)) from e
+
+        # 查询不断，不保留阶段记录；只在本线程内关闭，不影响同一进程中的其他流程
+        with instrument.recording(False):
+            result = report(data, dct_dimension, DCT_COL, **kwargs)
+
+        with self._lock:
+            if version == self.version: # 计算期间重新加载过的结果不缓存
+                self._cache[key] = result
+                while len(self._cache) > self.maxsize:
+                    self._cache.popitem(last=False)
+
+        return(result, False)
+
+    def parse(self, func, qs):
+        """HTTP查询参数转为query的参数：取值按字段类型转换"""
+
+        if func not in FUNCS:
+            raise KeyError('未知的报表函数：' + func)
+        params = FUNCS[func][1]
+
+        kwargs = {}
+        for k, v in qs.items():
+            if k in ('where', 'format'):
+                continue
+            if k not in params:
+                raise KeyError('{0}不支持参数：{1}'.format(func, k))
+            kwargs[k] = [x for x in v[-1].split(',') if x] if params[k] is list else v[-1]
+
+        where = []
+        for x in qs.get('where', []):
+            m = _WHERE.match(x)
+            if m is None or m.group(1) not in self.db_month_end.columns:
+                raise ValueError('无法识别的过滤条件：' + x)
+            col, op, value = m.groups()
+            where.append((col, op, self._value(self.db_month_end[col], value)))
+
+        return(kwargs, where)
+
+    @staticmethod
+    def _value(s, value):
+        """过滤条件的取值按字段类型转换"""
+
+        dtype = s.cat.categories.dtype if isinstance(s.dtype, pd.CategoricalDtype) else s.dtype
+        if pd.api.types.is_datetime64_any_dtype(dtype):
+            return(pd.Timestamp(value))
+        if pd.api.types.is_numeric_dtype(dtype):
+            return(float(value))
+
+        return(value)
+
+def _json(tables):
+    """表转为JSON：多层表头、索引按split格式展开"""
+
+    return([json.loads(x.to_json(orient='split', date_format='iso', force_ascii=False)) for x in tables])
+
+def _xlsx(tables):
+    """表依次纵向排列在同一页，返回工作簿内容"""
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'result.xlsx')
+        with Workbook(path, 'yyyy-mm-dd') as book:
+            book.add('查询结果', tables)
+        with open(path, 'rb') as f:
+            return(f.read())
+
+class Handler(BaseHTTPRequestHandler):
+    """HTTP接口：GET /函数名?参数，GET /reload重新加载，GET /查看可用函数"""
+
+    service = None
+
+    def _send(self, code, body, content_type='application/json; charset=utf-8'):
+        if not isinstance(body, bytes):
+            body = json.dumps(body, ensure_ascii=False, default=str).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        func, qs = url.path.strip('/'), parse_qs(url.query)
+        try:
+            if not func:
+                return(self._send(200, {'version':self.service.version,
+                                        'funcs':{k:list(v[1]) for k, v in FUNCS.items()}}))
+            if func == 'reload':
+                return(self._send(200, {'version':self.service.reload()}))
+
+            t0 = time.perf_counter()
+            kwargs, where = self.service.parse(func, qs)
+            result, cached = self.service.query(func, where, **kwargs)
+            tables = _tables(result)
+
+            if qs.get('format', ['json'])[-1] == 'xlsx':
+                return(self._send(200, _xlsx(tables),
+                                  'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'))
+            self._send(200, {'version':self.service.version, 'cached':cached, 'elapsed':time.perf_counter() - t0,
+                             'tables':_json(tables)})
+        except (KeyError, ValueError) as e:
+            self._send(400, {'error':e.args[0] if e.args else str(e)})
+        except Exception as e:
+            self._send(500, {'error':'{0}: {1}'.format(type(e).__name__, e)})
+
+def serve(service, host='127.0.0.1', port=8050):
+    """启动HTTP服务，直到中断"""
+
+    Handler.service = service
+    server = ThreadingHTTPServer((host, port), Handler)
+    print('报表查询服务：http://{0}:{1}/'.format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+#%%
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='报表查询服务')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8050)
+    parser.add_argument('--dt-begin', default='20151101', help='月末数据起始月份')
+    parser.add_argument('--maxsize', type=int, default=128, help='缓存的查询结果数')
+    args = parser.parse_args()
+
+    serve(ReportService(get_engine('oracle'), args.dt_begin, maxsize=args.maxsize), args.host, args.port)
@@ -1,142 +1,289 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import datetime
+import multiprocessing as mp
+import operator
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import wait
+
+import numpy as np
 import pandas as pd
-import xlwings as xw
-from sqlalchemy import create_engine
-
-import config
-
-def _translate(df, dct_dimension, dct_col, is_dimension=False):
-    """翻译字段"""
-
-    temp = df.copy()
-    
-    if is_dimension:
-        # 翻译数据值维度
-        temp = temp.apply(lambda x:x.map(dct_dimension[x.name])
-        if ((x.name in dct_dimension) and (9999 not in dct_dimension.get(x.name))) else x)
-        
-    else:
-        # 翻译行标题和列标题
-        [temp.rename(index=dct_dimension[x], level=x, inplace=True) for x in temp.index.names if x in dct_dimension]
-        [temp.rename(columns=dct_dimension[x], level=x, inplace=True) for x in temp.columns.names if x in dct_dimension]
+from dateutil.relativedelta import relativedelta
+
+import instrument
+from datastore import MonthStore, SqlTable, call_risk_stat_month, get_engine, load_dimension, run_parallel
+from instrument import stage, staged
+from workbook import GAP, Workbook
+
+# fork子进程共享的任务及数据，避免逐个任务序列化大表
+_SHARED = {}
+
+# 字段中文名
+DCT_COL = {'data_dt':'月份',
+           'cnt':'户数',
+           'od_amt':'金额',
+           'diff_od_amt':'逾期金额增量',
+           'loan_pr':'贷款本金',
+           'loan_pr_scope':'本金范围',
+           'new_amt':'新增放款金额',
+           'begin_date':'放款日期',
+           'aipmchttype':'产品类型',
+           'repay_period':'还款方式',
+           'prov_cd':'省市',
+           'white':'白户',
+           'applysource':'特例违例',
+           'reloantimes':'首续贷',
+           'stage':'阶段',
+           'light':'红黄绿灯',
+           'loan_period_mon':'贷款期长'}
+
+# vintage月份列的起始月份：首批放款月份
+VINTAGE_START = '20150801'
+
+# 汇总条件运算符
+_OPS = {'==':operator.eq, '!=':operator.ne, '>':operator.gt, '>=':operator.ge, '<':operator.lt, '<=':operator.le}
+
+# 汇总口径：[(条件, {字段:列名}), ...]
+_SPECS_OD = [
+        ((), {'cnt':'放款人次', 'loan_pr':'放款总额', 'bal_prin':'贷款本金余额', 'bal':'贷款余额'}),
+        ((('overdue_status_3', '!=', 2),), {'cnt':'未结清户数'}),
+        ((('new_loan', '==', 1),), {'cnt':'月度新增'}),
+        ((('overdue_status_3', '==', 1),), {'cnt':'本金逾期户数', 'od_principal':'本金逾期金额', 'od_amt':'逾期金额'}),
+        ((('overdue_status_3', '==', 1), ('maturity_days', '>', 0)), {'cnt':'银行逾期户数', 'od_principal':'本金银行逾期', 'od_amt':'银行逾期'}),
+        ((('overdue_status_3', '==', 1), ('maturity_days', '>', 2)), {'cnt':'不良逾期户数', 'od_principal':'本金不良金额', 'od_amt':'不良金额'})]
+
+_SPECS_OD_LAST = [
+        ((('overdue_status_3', '!=', 2),), {'cnt':'未结清户数', 'loan_pr':'放款总额', 'sp_amt':'应还总额', 'bal':'贷款余额'}),
+        ((('overdue_status_3', '==', 1),), {'cnt':'逾期户数', 'od_amt':'逾期金额'})]
+
+_SPECS_TOUKONG = [
+        ((), {'bal_prin':'期末本金'}),
+        ((('new_maturity_days', '>', 0),), {'od_principal_0':'逾期本金'}),
+        ((('new_maturity_days', '>', 2),), {'od_principal_0':'不良本金'})]
+
+_SPECS_RELOAN_MCD = [
+        ((('reloantimes', '==', 2),), {'cnt':'续贷户数'}),
+        ((('reloantimes', '==', 1), ('overdue_status_3', '==', 2)), {'cnt':'结清户数'})]
+
+_SPECS_RELOAN_DB = [
+        ((('new_loan', '==', 1), ('reloan', '>', 1)), {'cnt':'续贷人次', 'loan_pr':'续贷金额'})]
+
+_SPECS_RELOAN_CUM = [
+        ((('reloantimes', '!=', 1),), {'cnt':'累计续贷人次', 'loan_pr':'累计续贷金额'})]
+
+# 状态迁徙：(上期状态字段, 本期状态字段, 输出的迁徙)
+_TRANS = [('new_loan', 'overdue_status_3', ['新增贷款-逾期']),
+          ('overdue_status_3_last', 'overdue_status_3', ['逾期-结清','逾期-逾期','逾期-非逾期','非逾期-结清','非逾期-逾期','非逾期-非逾期']),
+          ('overdue_status_5_last', 'overdue_status_5', ['一般-一般','一般-催收','一般-严重','催收-一般','催收-催收','催收-严重','严重-严重']),
+          ('status_last_month', 'status_this_month', ['活动状态(active)-终止(terminate)'])]
+
+# 汇总立方体的求和字段：报表用到的金额、计数字段
+_CUBE_VALUES = ['cnt', 'loan_pr', 'bal_prin', 'bal', 'sp_amt', 'od_principal', 'od_amt', 'od_principal_0',
+                'od_amt_0', 'od_amt_30', 'diff_od_amt']
+
+# 立方体键分档：只在报表条件的阈值处区分，取值归并为所在档的下限，低于首档归为首档减1
+_CUBE_BUCKETS = {'maturity_days':[0, 1, 3], 'new_maturity_days':[0, 1, 3], 'reloan':[1, 2]}
+
+# 报表族的立方体键：只含本族报表分组及条件用到的字段，套表维度另行加入
+# 全部维度交叉的立方体几乎不比明细少，各族分开汇总后只有明细的1%~10%
+_CUBE_FAMILIES = {'overdue':['data_dt', 'loan_pr_scope', 'new_loan', 'overdue_status_3', 'maturity_days'],
+                  'status_trans':['data_dt', 'new_loan', 'overdue_status_3', 'overdue_status_5', 'overdue_status_3_last',
+                                  'overdue_status_5_last', 'status_last_month', 'status_this_month'],
+                  'vintage':['data_dt', 'begin_date', 'prov_cd'],
+                  'reloan':['data_dt', 'begin_date', 'new_loan', 'overdue_status_3', 'reloantimes', 'reloan'],
+                  'toukong':['data_dt', 'begin_date', 'new_maturity_days', 'stage', 'prov_cd']}
+
+def _recode(index, dct_dimension, dct_col):
+    """翻译索引：只替换各层去重后的取值并重新编码，层名按dct_col翻译"""
+    
+    def _map(level):
+        dct = dct_dimension.get(level.name, {})
+        return(pd.Index([dct.get(x, x) for x in level], name=level.name))
+    
+    if isinstance(index, pd.MultiIndex):
+        levels, codes = [], []
+        for level, code in zip(index.levels, index.codes):
+            if level.name in dct_dimension:
+                # 不同编码可能翻译为同一名称，重新编码去重
+                new_code, level = pd.factorize(_map(level))
+                code = np.where(code >= 0, new_code[code], -1)
+            levels.append(level)
+            codes.append(code)
+        index = pd.MultiIndex(levels=levels, codes=codes, names=index.names, verify_integrity=False)
+    elif index.name in dct_dimension:
+        code, level = pd.factorize(index)
+        index = _map(pd.Index(level, name=index.name)).take(code, allow_fill=True, fill_value=np.nan)
+    
+    return(index.set_names([dct_col.get(x, x) for x in index.names]))
+
+def _translate(df, dct_dimension, dct_col):
+    """翻译行标题和列标题，不复制表中数据"""
+    
+    temp = df.copy(deep=False)
+    temp.index = _recode(df.index, dct_dimension, dct_col)
+    temp.columns = _recode(df.columns, dct_dimension, dct_col)
     
-        # 翻译行名和列名
-        temp.index.names = pd.Series(temp.index.names).map(lambda x: dct_col[x] if x in dct_col else x)
-        temp.columns.names = pd.Series(temp.columns.names).map(lambda x: dct_col[x] if x in dct_col else x)
-
     return(temp)
 
-def _patch(df, idx_dates=None):
-    """插入数据透视表缺失月份列，转化为vintage"""
-    temp = df.copy()
+def _patch(df, dt_start, idx_dates=None):
+    """插入数据透视表缺失月份列，转化为vintage
+    
+    月份列为VINTAGE_START至今的全部月末，列名“第N个月”按相对dt_start（明细中最早的放款日期）的月数计算。
+    对角线补零只对以放款月份为行标题的单层表，按月份顺序逐月补，遇到没有该放款月份的行即停止，
+    多层行标题及阶段等非日期行标题不补。
+    """
     
     # idx_dates是df的日期index列表
     if idx_dates is None:
-        if isinstance(temp.index, pd.MultiIndex):
-            idx_dates = temp.index.get_level_values(len(temp.index.levels)-1)
+        if isinstance(df.index, pd.MultiIndex):
+            idx_dates = df.index.get_level_values(len(df.index.levels)-1)
         else:
-            idx_dates = temp.index
+            idx_dates = df.index
     
-    # 插入新列
-    for i, dt in enumerate(pd.date_range('20150801', pd.datetime.today().strftime('%Y%m%d'), freq='M')):
-        if dt not in temp.columns:
-            temp.insert(i, dt, idx_dates.map(lambda x: pd.np.nan if x > dt else 0))
+    # 月份列：VINTAGE_START至今的全部月末，并入透视表已有月份
+    df_months = pd.DatetimeIndex(df.columns)
+    months = pd.date_range(VINTAGE_START, pd.Timestamp.today(), freq=pd.offsets.MonthEnd()).union(df_months)
+    values = df.set_axis(df_months, axis=1).reindex(columns=months).values.astype(float)
+    row_dates = pd.DatetimeIndex(idx_dates).values[:, None]
     
-    # 对角线空白补零
-    try:
-        for dt in temp.columns:
-            if pd.isnull(temp.loc[dt, dt]):
-                temp.loc[dt, dt] = 0
-    except KeyError: # 忽略错误
-        pass
-    
-    # 左移空白单元格
-    temp = temp.apply(lambda x:x.shift(-x.index.get_loc(x.first_valid_index())), axis=1).rename(
-            columns=lambda x: '第' + 
-            str(pd.offsets.relativedelta(x, db_data.begin_date.min()).years * 12 + pd.offsets.relativedelta(x, db_data.begin_date.min()).months) + 
-            '个月')
+    # 插入新列：放款前为空，放款后补零
+    missing = ~months.isin(df_months)
+    values[:, missing] = np.where(row_dates > months.values[None, missing], np.nan, 0)
     
-    return(temp)
+    # 对角线空白补零：逐月取放款当月的行，首个缺失的放款月份之后不再补
+    if not isinstance(df.index, pd.MultiIndex):
+        rows = df.index.get_indexer(months) if df.index.is_unique else np.full(len(months), -1)
+        n = np.argmax(rows < 0) if (rows < 0).any() else len(months)
+        diagonal = values[rows[:n], np.arange(n)]
+        values[rows[:n], np.arange(n)] = np.where(np.isnan(diagonal), 0, diagonal)
+    
+    # 左移空白单元格：按每行首个有效月份对齐
+    valid = ~np.isnan(values)
+    first = np.where(valid.any(axis=1), valid.argmax(axis=1), 0)
+    src = first[:, None] + np.arange(len(months))[None, :]
+    values = np.where(src < len(months), np.take_along_axis(values, np.minimum(src, len(months)-1), axis=1), np.nan)
+    
+    dt_start = pd.Timestamp(dt_start)
+    columns = pd.Index(['第{0}个月'.format(x.years * 12 + x.months) for x in (relativedelta(y, dt_start) for y in months)],
+                       name=df.columns.name)
+    
+    return(pd.DataFrame(values, index=df.index, columns=columns))
+
+def _compare(s, op, value):
+    """单个条件的布尔数组：分类字段按取值比较（与有序分类的类别无关），只比较各类别再按编码取出，空值只满足!="""
+
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        hits = np.append(np.asarray(_OPS[op](s.cat.categories, value), dtype=bool), op == '!=') # 编码-1（空值）取末位
+        return(hits[s.cat.codes.values])
+
+    return(np.asarray(_OPS[op](s, value), dtype=bool))
 
+def _mask(data, cond, mask=None):
+    """条件转为布尔数组：cond为[(字段, 运算符, 值), ...]，各条件取且"""
+
+    mask = np.ones(len(data), dtype=bool) if mask is None else mask.copy()
+    for col, op, value in cond:
+        mask &= _compare(data[col], op, value)
+    
+    return(mask)
+
+def _agg(data, gp_keys, specs, where=()):
+    """分组条件汇总：一次groupby完成specs中全部条件求和
+    
+    specs为[(条件, {字段:列名}), ...]，条件为空表示不过滤；where为所有条件共用的前置条件。
+    条件求和转为掩码列，不生成过滤后的数据副本；data为SqlTable时下推到数据库汇总。
+    """
+    
+    if isinstance(data, SqlTable):
+        return(data.agg(gp_keys, specs, where))
+    
+    base = _mask(data, where) if where else None
+    
+    cols = {x:data[x].values for x in gp_keys}
+    hits = []
+    for i, (cond, names) in enumerate(specs):
+        mask = _mask(data, cond, base) if cond else base
+        if mask is not None:
+            # 命中行数，用于只保留满足任一条件的分组
+            hits.append('_hit_{0}'.format(i))
+            cols[hits[-1]] = mask
+        for col, name in names.items():
+            cols[name] = data[col].values if mask is None else np.where(mask, data[col].values, 0)
+    
+    result = pd.DataFrame(cols).groupby(gp_keys, observed=True).sum()
+    if len(hits) == len(specs):
+        result = result[result[hits].any(axis=1)]
+    
+    return(result.drop(columns=hits))
+
+@staged
 def overdue(db_data, dct_dimension, dct_col, gp_keys_all, gp_keys_last, gp_keys_prov=None):
     """逾期不良表"""
 
-    def od_template(data, gp_keys):
-        """逾期不良模板表"""
-        all_1 = data[gp_keys+['cnt','loan_pr','bal_prin','bal']].groupby(gp_keys).sum().rename(
-                columns={'cnt':'放款人次', 'loan_pr':'放款总额', 'bal_prin':'贷款本金余额', 'bal':'贷款余额'})
-        all_2 = data[(data.overdue_status_3 != 2)][gp_keys+['cnt']].groupby(gp_keys).sum().rename(
-                columns={'cnt':'未结清户数'})
-        all_3 = data[(data.new_loan == 1)][gp_keys+['cnt']].groupby(gp_keys).sum().rename(
-                columns={'cnt':'月度新增'})
-        all_4 = data[(data.overdue_status_3 == 1)][gp_keys+['cnt', 'od_principal', 'od_amt']].groupby(gp_keys).sum().rename(
-                columns={'cnt':'本金逾期户数', 'od_principal':'本金逾期金额', 'od_amt':'逾期金额'})
-        all_5 = data[(data.overdue_status_3 == 1) & (data.maturity_days > 0)][gp_keys+['cnt', 'od_principal', 'od_amt']].groupby(gp_keys).sum().rename(
-                columns={'cnt':'银行逾期户数', 'od_principal':'本金银行逾期', 'od_amt':'银行逾期'})
-        all_6 = data[(data.overdue_status_3 == 1) & (data.maturity_days > 2)][gp_keys+['cnt', 'od_principal', 'od_amt']].groupby(gp_keys).sum().rename(
-                columns={'cnt':'不良逾期户数', 'od_principal':'本金不良金额', 'od_amt':'不良金额'})
-    
-        dfs = [all_1, all_2, all_3, all_4, all_5, all_6]
-        result = pd.concat(dfs, axis=1).fillna(0)
-        result.index.name=all_1.index.name # pandas的bug https://github.com/pandas-dev/pandas/issues/13475
-        
-        return(result)
-
     # 每月数据
-    data_all = od_template(db_data, gp_keys_all)
+    data_all = _agg(db_data, gp_keys_all, _SPECS_OD)
     
     # 当月金额范围数据
-    db_data_last = db_data[db_data.data_dt == db_data.data_dt.max()]
-    
-    last_1 = db_data_last[(db_data_last.overdue_status_3 != 2)][gp_keys_last+['cnt', 'loan_pr', 'sp_amt', 'bal']].groupby(gp_keys_last).sum().rename(
-            columns={'cnt':'未结清户数', 'loan_pr':'放款总额', 'sp_amt':'应还总额', 'bal':'贷款余额'})
-    last_2 = db_data_last[(db_data_last.overdue_status_3 == 1)][gp_keys_last+['cnt', 'od_amt']].groupby(gp_keys_last).sum().rename(
-            columns={'cnt':'逾期户数', 'od_amt':'逾期金额'})
-    
-    dfs_last = [last_1, last_2]
-    data_last = pd.concat(dfs_last, axis=1).fillna(0)
+    dt_last = db_data.max('data_dt') if isinstance(db_data, SqlTable) else db_data.data_dt.max()
+    where_last = [('data_dt', '==', dt_last)]
+    data_last = _agg(db_data, gp_keys_last, _SPECS_OD_LAST, where_last)
 
     # 当月各省数据
     if gp_keys_prov:
-        data_prov = od_template(db_data_last, gp_keys_prov)
+        data_prov = _agg(db_data, gp_keys_prov, _SPECS_OD, where_last)
     
     # 返回结果
     return([_translate(data_all,dct_dimension,dct_col), 
             _translate(data_last,dct_dimension,dct_col),
             _translate(data_prov,dct_dimension,dct_col) if gp_keys_prov else None])
 
+@staged
 def overdue_toukong(db_data, dct_dimension, dct_col, gp_keys_all):
     """投控逾期不良"""
     
-    all_1 = db_data[gp_keys_all+['bal_prin']].groupby(gp_keys_all).sum().rename(
-            columns={'bal_prin':'期末本金'})
-    all_2 = db_data[(db_data.new_maturity_days > 0)][gp_keys_all+['od_principal_0']].groupby(gp_keys_all).sum().rename(
-            columns={'od_principal_0':'逾期本金'})
-    all_3 = db_data[(db_data.new_maturity_days > 2)][gp_keys_all+['od_principal_0']].groupby(gp_keys_all).sum().rename(
-            columns={'od_principal_0':'不良本金'})
-    
-    dfs_all = [all_1, all_2, all_3]
-    data_all = pd.concat(dfs_all, axis=1).fillna(0)
+    data_all = _agg(db_data, gp_keys_all, _SPECS_TOUKONG)
     data_all['逾期率'] = data_all['逾期本金'] / data_all['期末本金']
     data_all['不良率'] = data_all['不良本金'] / data_all['期末本金']
     
     # 返回结果
     return(_translate(data_all,dct_dimension,dct_col))
     
+def _code(s, dct):
+    """按字典键转为整数编码，字典外取值（含空值）为-1"""
+    return(pd.Categorical(s, categories=list(dct)).codes.astype(np.int64))
+
+@staged
 def status_trans(db_data, dct_dimension, dct_col, index_values, pivot_values_all, pivot_values_trans):
     """状态迁徙表"""
     
-    # 翻译维度
-    db_data = _translate(db_data, dct_dimension, dct_col, True)
+    def _label(index):
+        """行标题按维度翻译，字典外取值为空（与先翻译明细再透视的口径一致）"""
+        dct = dct_dimension.get(index.name)
+        if dct is None or 9999 in dct:
+            return(index)
+        return(pd.Index([dct.get(x, np.nan) for x in index], name=index.name))
+    
+    def _pivot(codes, labels, values):
+        """按状态编码分组求和，只在汇总结果上替换为标签
+        
+        行、列标题翻译后按名称排序，翻译为同一名称的合并，空值剔除，与按翻译后数据透视的结果一致。
+        """
+        key = pd.Series(np.where(codes >= 0, codes, np.nan), index=db_data.index, name='_code')
+        result = db_data[values].groupby([db_data[x] for x in index_values] + [key], observed=True).sum().unstack('_code')
+        result = result.groupby([_label(result.index.get_level_values(x)) for x in range(result.index.nlevels)],
+                                observed=True).sum(min_count=1)
+        result.columns = pd.MultiIndex.from_arrays([result.columns.get_level_values(0),
+                                                    [labels[int(x)] for x in result.columns.get_level_values(1)]])
+        return(result.T.groupby(level=[0, 1]).sum(min_count=1).T)
     
     # 总体状态==========
-    all_1 = db_data.pivot_table(values=pivot_values_all, index=index_values, columns=['new_loan'], aggfunc='sum')
-    all_2 = db_data.pivot_table(values=pivot_values_all, index=index_values, columns=['overdue_status_5'], aggfunc='sum')
-    all_3 = db_data.pivot_table(values=pivot_values_all, index=index_values, columns=['overdue_status_3'], aggfunc='sum')
-
-    dfs_all = [all_1, all_2, all_3]
+    dfs_all = [_pivot(_code(db_data[x], dct_dimension[x]), list(dct_dimension[x].values()), pivot_values_all)
+               for x in ['new_loan', 'overdue_status_5', 'overdue_status_3']]
     data_all = pd.concat(dfs_all, axis=1)[pivot_values_all].fillna(0)
     
     # 特殊处理
@@ -144,30 +291,23 @@ def status_trans(db_data, dct_dimension, dct_col, index_values, pivot_values_all
     data_all.rename(columns=dct_col, level=0, inplace=True)
     
     # 状态迁徙==========
-    db_data['trans_nl_od'] = db_data.new_loan + '-' + db_data.overdue_status_3
-    db_data['trans_od_3'] = db_data.overdue_status_3_last + '-' + db_data.overdue_status_3
-    db_data['trans_od_5'] = db_data.overdue_status_5_last + '-' + db_data.overdue_status_5
-    db_data['trans_status'] = db_data.status_last_month + '-' + db_data.status_this_month
-    
-    # 过滤nan
-    db_data_trans = db_data[~(db_data['trans_nl_od'].str.contains('nan') |
-                              db_data['trans_od_3'].str.contains('nan') |
-                              db_data['trans_od_5'].str.contains('nan') |
-                              db_data['trans_status'].str.contains('nan'))]
-    
-    trans_1 = db_data_trans.pivot_table(values=pivot_values_trans, index=index_values, columns=['trans_nl_od'], aggfunc='sum').loc[
-            :,(slice(None),['新增贷款-逾期'])]
-    trans_2 = db_data_trans.pivot_table(values=pivot_values_trans, index=index_values, columns=['trans_od_3'], aggfunc='sum').loc[
-            :,(slice(None),['逾期-结清','逾期-逾期','逾期-非逾期','非逾期-结清','非逾期-逾期','非逾期-非逾期'])]
-    trans_3 = db_data_trans.pivot_table(values=pivot_values_trans, index=index_values, columns=['trans_od_5'], aggfunc='sum').loc[
-            :,(slice(None),['一般-一般','一般-催收','一般-严重','催收-一般','催收-催收','催收-严重','严重-严重'])]
-    trans_4 = db_data_trans.pivot_table(values=pivot_values_trans, index=index_values, columns=['trans_status'], aggfunc='sum').loc[
-            :,(slice(None),['活动状态(active)-终止(terminate)'])]
+    # 上期编码×本期状态数+本期编码，一次分组得到全部迁徙
+    dfs_trans = []
+    for col_last, col, lst_trans in _TRANS:
+        dct_last, dct = dct_dimension[col_last], dct_dimension[col]
+        code_last, code = _code(db_data[col_last], dct_last), _code(db_data[col], dct)
+        codes = np.where((code_last >= 0) & (code >= 0), code_last * len(dct) + code, -1)
+        labels = [x + '-' + y for x in dct_last.values() for y in dct.values()]
+        # 只保留出现过的迁徙
+        result = _pivot(codes, labels, pivot_values_trans)
+        present = set(result.columns.get_level_values(1))
+        dfs_trans.append(result.reindex(columns=pd.MultiIndex.from_product([pivot_values_trans, [x for x in lst_trans if x in present]])))
+    trans_1, trans_2, trans_3, trans_4 = dfs_trans
     
     temp_index = trans_2.index if len(trans_2) > len(trans_4) else trans_4.index
-    trans_5 = (trans_2.loc[:,(slice(None), ['逾期-逾期'])].reindex(index=temp_index).rename(columns={'逾期-逾期':'正常出账'}) - 
-               trans_4.loc[:,(slice(None), ['活动状态(active)-终止(terminate)'])].reindex(index=temp_index).rename(
-                       columns={'活动状态(active)-终止(terminate)':'正常出账'}))
+    _trans = lambda df, label: df.reindex(index=temp_index, columns=pd.MultiIndex.from_product([pivot_values_trans, [label]])).rename(
+            columns={label:'正常出账'})
+    trans_5 = _trans(trans_2, '逾期-逾期') - _trans(trans_4, '活动状态(active)-终止(terminate)')
     
     dfs_trans = [trans_1, trans_2, trans_3, trans_4, trans_5]
     data_trans = pd.concat(dfs_trans, axis=1)[pivot_values_trans].fillna(0)
@@ -179,88 +319,166 @@ def status_trans(db_data, dct_dimension, dct_col, index_values, pivot_values_all
     return([_translate(data_all,dct_dimension,dct_col), 
             _translate(data_trans,dct_dimension,dct_col)])
 
-def vintage(db_data, dct_dimension, dct_col, gp_keys_all, gp_value = 'od_amt'):
-    """vintage表"""
+def _vintage_sums(db_data, gp_keys, gp_value):
+    """vintage各月份汇总：逾期金额、贷款本金求和，另计行数及金额非零的行数
+    
+    行数用于判断分组在剔除后是否仍存在，非零行数用于将相减后只剩浮点误差的金额置为0。
+    """
+    
+    data = db_data[gp_keys + ['data_dt', gp_value, 'loan_pr']]
+    nonzero = data[[gp_value, 'loan_pr']].fillna(0).ne(0).add_prefix('_nz_')
+    grouped = pd.concat([data, nonzero], axis=1).groupby(gp_keys + ['data_dt'], observed=True)
+    sums = grouped[[gp_value, 'loan_pr'] + list(nonzero.columns)].sum()
+    sums['_n'] = grouped.size()
+    
+    return(sums)
+
+def _vintage_tables(sums, dt_start, dct_dimension, dct_col, gp_keys_all, gp_value, first=None):
+    """由各月份汇总生成vintage金额表和比例表"""
+    
+    pivot = lambda x: sums[x].unstack('data_dt')
     
     if gp_keys_all == ['prov_cd']: # 特殊处理 prov_cd
         # 金额
-        all_1 = db_data[gp_keys_all+['begin_date']].groupby(gp_keys_all).min().sort_values('begin_date').rename(columns=dct_col)
-        all_2 = db_data.pivot_table(values=gp_value, index=gp_keys_all, columns=['data_dt'], aggfunc='sum')
+        all_1 = first.sort_values('begin_date').rename(columns=dct_col)
+        all_2 = pivot(gp_value)
         
         dfs_all = [all_1, all_2]
         data_all_value = pd.concat(dfs_all, axis=1).reindex(all_1.index)
-        data_all_value = _patch(data_all_value.set_index([data_all_value.index, dct_col['begin_date']]), 
+        data_all_value = _patch(data_all_value.set_index([data_all_value.index, dct_col['begin_date']]), dt_start,
                                pd.Index(data_all_value[dct_col['begin_date']]))
         
         # 比例：每个省份开始放款后的后续月份的逾期金额/对应月份贷款本金
-        all_3 = db_data.pivot_table(values='loan_pr', index=gp_keys_all, columns=['data_dt'], aggfunc='sum')
+        all_3 = pivot('loan_pr')
         temp_pct = all_2 / all_3
         
         dfs_all = [all_1, temp_pct]
         data_all_pct = pd.concat(dfs_all, axis=1).reindex(all_1.index)
-        data_all_pct = _patch(data_all_pct.set_index([data_all_pct.index, dct_col['begin_date']]), 
+        data_all_pct = _patch(data_all_pct.set_index([data_all_pct.index, dct_col['begin_date']]), dt_start,
                              pd.Index(data_all_pct[dct_col['begin_date']]))
         
-    elif gp_keys_all == ['stage', 'begin_date']: # 特殊处理 stage
+        return([data_all_value, data_all_pct])
+    
+    # 当月放款金额
+    all_1 = sums.xs(sums.index.get_level_values('data_dt').max(), level='data_dt')[['loan_pr']].rename(
+            columns={'loan_pr':'新增放款金额'})
+    
+    if gp_keys_all == ['stage', 'begin_date']: # 特殊处理 stage
         # 获取节点月末日期
-        lst_month_break = sorted([pd.datetime.strptime(x.split(',')[0][-10:], '%Y/%m/%d') + pd.tseries.offsets.MonthEnd()
+        lst_month_break = sorted([datetime.datetime.strptime(x.split(',')[0][-10:], '%Y/%m/%d') + pd.tseries.offsets.MonthEnd()
                             for x in dct_dimension['stage'].values()])
         
         # 金额
-        all_1 = db_data[db_data.data_dt == db_data.data_dt.max()][[gp_keys_all[0]]+['loan_pr']].groupby(gp_keys_all[0]).sum().rename(
-                columns={'loan_pr':'新增放款金额'})
-        all_2 = _patch(db_data.pivot_table(values=gp_value, index=gp_keys_all[0], columns=['data_dt'], aggfunc='sum'),
-                               pd.DatetimeIndex([x.strftime('%Y/%m/%d') for x in lst_month_break]))
+        all_2 = _patch(pivot(gp_value), dt_start, pd.DatetimeIndex([x.strftime('%Y/%m/%d') for x in lst_month_break]))
         
         dfs_all = [all_1, all_2]
         data_all_value = pd.concat(dfs_all, axis=1)
         
         # 比例：每个阶段各个月份的逾期金额/对应月份贷款本金
-        all_3 = _patch(db_data.pivot_table(values='loan_pr', index=gp_keys_all[0], columns=['data_dt'], aggfunc='sum'),
-                           pd.DatetimeIndex([x.strftime('%Y/%m/%d') for x in lst_month_break]))
+        all_3 = _patch(pivot('loan_pr'), dt_start, pd.DatetimeIndex([x.strftime('%Y/%m/%d') for x in lst_month_break]))
         temp_pct = all_2 / all_3
         dfs_all = [all_1, temp_pct]
         data_all_pct = pd.concat(dfs_all, axis=1)
         
     else: # 一般情况
         # 金额
-        all_1 = db_data[db_data.data_dt == db_data.data_dt.max()][gp_keys_all+['loan_pr']].groupby(gp_keys_all).sum().rename(
-                columns={'loan_pr':'新增放款金额'})
-        all_2 = _patch(db_data.pivot_table(values=gp_value, index=gp_keys_all, columns=['data_dt'], aggfunc='sum'))
+        all_2 = _patch(pivot(gp_value), dt_start)
         
         dfs_all = [all_1, all_2]
         data_all_value = pd.concat(dfs_all, axis=1)
         
         # 比例：各个月贷款本金在后续月份的逾期金额/当月贷款本金
-        data_all_pct = data_all_value.apply(lambda x: x/data_all_value['新增放款金额']).replace([pd.np.inf, -pd.np.inf], pd.np.nan)
+        data_all_pct = data_all_value.apply(lambda x: x/data_all_value['新增放款金额']).replace([np.inf, -np.inf], np.nan)
         data_all_pct.iloc[:,0] = data_all_value.iloc[:,0]
+    
+    return([data_all_value, data_all_pct])
+
+def _vintage(db_data, dct_dimension, dct_col, gp_keys_all, gp_value, ex_prov=None):
+    """vintage表，ex_prov不为空时另返回剔除省市后的表"""
+    
+    gp_keys = gp_keys_all[:1] if gp_keys_all == ['stage', 'begin_date'] else gp_keys_all
+    sums = _vintage_sums(db_data, gp_keys, gp_value)
+    
+    # 各省份首次放款日期
+    first = db_data[gp_keys_all+['begin_date']].groupby(gp_keys_all, observed=True).min() if gp_keys_all == ['prov_cd'] else None
+    
+    results = [_vintage_tables(sums, db_data.begin_date.min(), dct_dimension, dct_col, gp_keys_all, gp_value, first)]
+    
+    if ex_prov is not None:
+        excluded = db_data.prov_cd.isin(ex_prov).values
+        sums_ex = sums.sub(_vintage_sums(db_data[excluded], gp_keys, gp_value).reindex(sums.index), fill_value=0)
+        sums_ex = sums_ex[sums_ex['_n'] > 0]
+        sums_ex.index = sums_ex.index.remove_unused_levels()
+        
+        # 剩余非零行数为0的金额即为0，去掉相减的浮点误差
+        for col in [gp_value, 'loan_pr']:
+            sums_ex[col] = sums_ex[col].mask(sums_ex['_nz_'+col] == 0, 0)
         
-    return([_translate(data_all_value,dct_dimension,dct_col), 
-            _translate(data_all_pct,dct_dimension,dct_col)])
+        first_ex = first[~first.index.isin(ex_prov)] if first is not None else None
+        results.append(_vintage_tables(sums_ex, db_data.begin_date.min(), dct_dimension, dct_col, gp_keys_all,
+                                       gp_value, first_ex))
+    
+    return([[_translate(x,dct_dimension,dct_col) for x in result] for result in results])
+
+@staged
+def vintage(db_data, dct_dimension, dct_col, gp_keys_all, gp_value = 'od_amt'):
+    """vintage表，返回[金额, 比例]"""
+    
+    return(_vintage(db_data, dct_dimension, dct_col, gp_keys_all, gp_value)[0])
+
+@staged
+def vintage_ex(db_data, dct_dimension, dct_col, gp_keys_all, ex_prov, gp_value = 'od_amt'):
+    """全部及剔除ex_prov省市的vintage表，返回[[全部金额, 全部比例], [剔除金额, 剔除比例]]
+    
+    剔除后的汇总由全部汇总减去剔除省市的汇总得到，比例按相减后的金额重新计算，不再对剔除后的数据重新透视。
+    """
+    
+    return(_vintage(db_data, dct_dimension, dct_col, gp_keys_all, gp_value, ex_prov))
+
+def _pivot_levels(db_data, gp_keys, value, col, edges):
+    """按col分档一次透视，档位累加得到各阈值的月份透视表
+    
+    edges为升序档位下限，返回[edges[0]<=col<edges[1], col>=edges[1], col>=edges[2], ...]口径的透视表。
+    """
+    
+    # 分档：低于首档及空值不参与
+    level = np.searchsorted(edges, db_data[col].values, side='right') - 1
+    level[np.isnan(db_data[col].values.astype(float))] = -1
+    
+    cube = db_data.groupby(gp_keys + ['data_dt', level], observed=True)[value].sum().unstack(-1).reindex(columns=range(len(edges)))
+    
+    # 沿档位逆向累加，全部为空的单元格保持为空
+    values = cube.values[:, ::-1]
+    cum = np.nancumsum(values, axis=1)[:, ::-1]
+    cum[~np.maximum.accumulate(~np.isnan(values), axis=1)[:, ::-1]] = np.nan
+    cum[:, 0] = cube.values[:, 0]
+    
+    return([pd.Series(cum[:, i], index=cube.index).dropna().unstack('data_dt') for i in range(len(edges))])
 
+@staged
 def vintage_toukong(db_data, dct_dimension, dct_col, gp_keys_all):
     """vintage表"""
     
     def _fill_upper(df):
         """vintage左上半三角补零"""
-        for i in range(df.shape[0]):
-            for j in range(df.shape[1]):
-                if i+j <= df.shape[0] and pd.isnull(df.iloc[i,j]):
-                    df.iloc[i,j] = 0
-        return(df)
+        upper = np.add.outer(np.arange(df.shape[0]), np.arange(df.shape[1])) <= df.shape[0]
+        return(df.mask(upper & df.isnull().values, 0))
+    
+    dt_start = db_data.begin_date.min()
     
-    all_1 = db_data[db_data.data_dt == db_data.data_dt.max()][gp_keys_all+['loan_pr']].groupby(gp_keys_all).sum().rename(
+    all_1 = db_data[db_data.data_dt == db_data.data_dt.max()][gp_keys_all+['loan_pr']].groupby(gp_keys_all, observed=True).sum().rename(
             columns={'loan_pr':'新增放款金额'})
-    all_2 = _patch(db_data[db_data.new_maturity_days == 0].pivot_table(values='od_amt_0', index=gp_keys_all, columns=['data_dt'], aggfunc='sum'))
-    all_3 = _patch(db_data[db_data.new_maturity_days >= 1].pivot_table(values='od_amt_0', index=gp_keys_all, columns=['data_dt'], aggfunc='sum'))
-    all_4 = _patch(db_data[db_data.new_maturity_days >= 3].pivot_table(values='od_amt_0', index=gp_keys_all, columns=['data_dt'], aggfunc='sum'))
+    
+    # 逾期期数分档：未逾期 / 30天以上 / 90天以上
+    all_2, all_3, all_4 = [_patch(x, dt_start) for x in _pivot_levels(db_data, gp_keys_all, 'od_amt_0', 'new_maturity_days', [0, 1, 3])]
     
     data_all_0 = pd.concat([all_1, all_2], axis=1)
     data_all_30 = pd.concat([all_1, all_3], axis=1)
     data_all_90 = pd.concat([all_1, all_4], axis=1)
     
-    data_all_30_stage_all = vintage(db_data, dct_dimension, dct_col, ['stage', 'begin_date'], 'od_amt_30')
-    data_all_30_stage_ex_xiamen = vintage(db_data[db_data.prov_cd!='3502'], dct_dimension, dct_col, ['stage', 'begin_date'], 'od_amt_30')
+    # 去厦门由全部减去厦门得到
+    data_all_30_stage_all, data_all_30_stage_ex_xiamen = vintage_ex(db_data, dct_dimension, dct_col, ['stage', 'begin_date'],
+                                                                    ['3502'], 'od_amt_30')
         
     return([_fill_upper(_translate(data_all_0,dct_dimension,dct_col)), 
             _fill_upper(_translate(data_all_30,dct_dimension,dct_col)),
@@ -268,24 +486,17 @@ def vintage_toukong(db_data, dct_dimension, dct_col, gp_keys_all):
             data_all_30_stage_all,
             data_all_30_stage_ex_xiamen])
 
+@staged
 def reloan(db_data, dct_dimension, dct_col, gp_keys_mcd, gp_keys_db):
     """续贷历史情况，只附加在首续贷表中"""
 
     # 按商户统计
-    mcd_1 = db_data[(db_data.reloantimes == 2)][gp_keys_mcd+['cnt']].groupby(gp_keys_mcd).sum().rename(
-            columns={'cnt':'续贷户数'})
-    mcd_2 = db_data[(db_data.reloantimes == 1) & (db_data.overdue_status_3 == 2)][gp_keys_mcd+['cnt']].groupby(gp_keys_mcd).sum().rename(
-            columns={'cnt':'结清户数'})
-
-    dfs_mcd = [mcd_1, mcd_2]
-    data_mcd = pd.concat(dfs_mcd, axis=1).fillna(0)
+    data_mcd = _agg(db_data, gp_keys_mcd, _SPECS_RELOAN_MCD)
     data_mcd.loc[:,'续贷率'] = data_mcd['续贷户数'] / data_mcd['结清户数']
     
     # 按借据统计
-    db_1 = db_data[(db_data.new_loan == 1) & (db_data.reloan > 1)][gp_keys_db+['cnt', 'loan_pr']].groupby(gp_keys_db).sum().rename(
-            columns={'cnt':'续贷人次', 'loan_pr':'续贷金额'})
-    db_2 = db_data[(db_data.reloantimes != 1)][gp_keys_mcd+['cnt', 'loan_pr']].groupby(gp_keys_mcd).sum().rename(
-            columns={'cnt':'累计续贷人次', 'loan_pr':'累计续贷金额'}) # gp_keys_mcd没错
+    db_1 = _agg(db_data, gp_keys_db, _SPECS_RELOAN_DB)
+    db_2 = _agg(db_data, gp_keys_mcd, _SPECS_RELOAN_CUM) # gp_keys_mcd没错
 
     dfs_db = [db_1, db_2]
     data_db = pd.concat(dfs_db, axis=1).fillna(0)
@@ -293,169 +504,289 @@ def reloan(db_data, dct_dimension, dct_col, gp_keys_mcd, gp_keys_db):
     return([_translate(data_mcd,dct_dimension,dct_col), 
             _translate(data_db,dct_dimension,dct_col)])
 
-def resize_sheets(file_path):
-    """Sheets列宽自适应"""
+def _bucket(values, edges):
+    """按档位下限归并取值，空值保持为空"""
     
-    writer = xw.Book(file_path)
-    [x.autofit() for x in writer.sheets]
-    writer.save()
-    writer.app.quit()
-
-#%%
-if __name__=='__main__':
+    values = np.asarray(values, dtype=float)
+    level = np.searchsorted(edges, values, side='right') - 1
+    
+    return(np.where(np.isnan(values), np.nan, np.where(level >= 0, np.take(edges, np.maximum(level, 0)), edges[0] - 1)))
 
-    # 连接数据库
-    engine_oracle = create_engine(config.ConfigDevelopment.DB_ORACLE['str'], 
-                                  connect_args={'encoding':'utf8', 'nencoding':'utf8'})
-    
-    # 获取字典
-    db_dimension = pd.read_sql("select * from risk_dimension", engine_oracle)
-    
-    dct_dimension = {db_dimension.iloc[x,0].lower():{} for x in range(len(db_dimension))}
-    [dct_dimension[db_dimension.iloc[x,0].lower()].update({db_dimension.iloc[x,1]:db_dimension.iloc[x,2]}) for x in range(len(db_dimension))]
-    dct_dimension['prov_cd'] = {str(x):y for x,y in dct_dimension['prov_cd'].items()} # 省市在stat_all里是字符，在dimension里是数字
-    
-    dct_col = {'data_dt':'月份',
-               'cnt':'户数',
-               'od_amt':'金额',
-               'diff_od_amt':'逾期金额增量',
-               'loan_pr':'贷款本金',
-               'loan_pr_scope':'本金范围',
-               'new_amt':'新增放款金额',
-               'begin_date':'放款日期',
-               'aipmchttype':'产品类型',
-               'repay_period':'还款方式',
-               'prov_cd':'省市',
-               'white':'白户',
-               'applysource':'特例违例',
-               'reloantimes':'首续贷',
-               'stage':'阶段',
-               'light':'红黄绿灯',
-               'loan_period_mon':'贷款期长'}
-
-    #%% 周末报表==============================
-    # 更新最近一个周四的数据，通过参数n调整最近第几个周四
-    dt_last_thu = pd.datetime.today() - pd.tseries.offsets.Week(n=1, weekday=3, normalize=True)
-    db_data_dt = pd.read_sql("select distinct data_dt from thbl.risk_statistics_all", engine_oracle)
-    if dt_last_thu not in set(db_data_dt.data_dt):
-        with engine_oracle.begin() as conn:
-            conn.execute("call RISK_STAT_MONTH('{0}',0)".format(dt_last_thu.strftime('%Y%m%d')))
-            print('新增周四数据：' + dt_last_thu.strftime('%F'))
-
-    # 获取周末数据
-    sql = "select * from thbl.risk_statistics_all where data_dt = TO_DATE('"+dt_last_thu.strftime('%Y%m%d')+"', 'YYYYMMDD')"
-    db_week_end = pd.read_sql(sql, engine_oracle)
-    
-    # 周末报表
-    db_data = db_week_end.copy()
-    overdue_weekly = overdue(db_data, dct_dimension, dct_col, ['data_dt'], ['loan_pr_scope'], ['prov_cd'])
-    
-    str_file_name = '风险周报_' + dt_last_thu.strftime('%Y%m%d') + '.xlsx'
-    with pd.ExcelWriter(str_file_name, datetime_format='yyyy-mm-dd') as writer:
-        overdue_weekly[0].to_excel(writer, sheet_name='逾期不良', startrow=0, startcol=0)
-        overdue_weekly[1].to_excel(writer, sheet_name='逾期不良', startrow=0, startcol=overdue_weekly[0].shape[1]+5)
-        overdue_weekly[2].to_excel(writer, sheet_name='逾期不良', startrow=5, startcol=0)
-
-    resize_sheets(str_file_name)
-
-    #%% 月末报表==============================
-    # 更新月末数据：可修改refresh_all全部刷新
-    # 客户端更新全量代码：print('\n'.join(["call RISK_STAT_MONTH('{0}',0);".format(dt.strftime('%Y%m%d')) for dt in lst_month]))
-    refresh_all = False
-    lst_month = pd.date_range('20151101',pd.datetime.today(),freq='m')
-    db_data_dt = pd.read_sql("select distinct data_dt from thbl.risk_statistics_all", engine_oracle)
-    target_month = lst_month if refresh_all else set(lst_month)-set(db_data_dt.data_dt)
-    with engine_oracle.begin() as conn:
-        for dt in target_month:
-            conn.execute("call RISK_STAT_MONTH('{0}',0)".format(dt.strftime('%Y%m%d')))
-            print('新增月末数据：' + dt.strftime('%F'))
-
-    # 获取月末数据
-    str_month = ', '.join(["TO_DATE('"+x.strftime('%Y%m%d')+"', 'YYYYMMDD')" for x in lst_month])
-    sql = "select * from thbl.risk_statistics_all where data_dt in ({0})".format(str_month)
-    db_month_end = pd.read_sql(sql, engine_oracle)
-    
-    # 投控报表
-    db_data = db_month_end.copy()
-    toukong_overdue = overdue_toukong(db_data, dct_dimension, dct_col, ['data_dt'])
-    toukong_vintage = vintage_toukong(db_data, dct_dimension, dct_col, ['begin_date'])
-    
-    str_file_name = '风险月报_' + pd.datetime.today().strftime('%Y%m%d') + '_投控.xlsx'
-    with pd.ExcelWriter(str_file_name, datetime_format='yyyy年mm月') as writer:
-        toukong_overdue.to_excel(writer, sheet_name='逾期不良', startrow=0, startcol=0)
-        toukong_vintage[0].to_excel(writer, sheet_name='全国30天以下资产情况', startrow=0, startcol=0)
-        toukong_vintage[1].to_excel(writer, sheet_name='全国30天以上资产情况', startrow=0, startcol=0)
-        toukong_vintage[2].to_excel(writer, sheet_name='全国90天以上资产情况', startrow=0, startcol=0)
-        toukong_vintage[3][0].to_excel(writer, sheet_name='按阶段全国30天以上资产情况', startrow=0, startcol=0)
-        toukong_vintage[3][1].to_excel(writer, sheet_name='按阶段全国30天以上资产情况', startrow=toukong_vintage[3][0].shape[0]+5, startcol=0)
-        toukong_vintage[4][0].to_excel(writer, sheet_name='按阶段去厦门30天以上资产情况', startrow=0, startcol=0)
-        toukong_vintage[4][1].to_excel(writer, sheet_name='按阶段去厦门30天以上资产情况', startrow=toukong_vintage[4][0].shape[0]+5, startcol=0)
-
-    resize_sheets(str_file_name)
-
-    #%% 套表
-    for gp in ['', 'aipmchttype', 'loan_period_mon', 'repay_period', 'white', 'applysource', 'reloantimes', 'light', 'prov_cd', 'stage']:
-        
-#        # 调试
-#        if gp not in ['aipmchttype', 'stage']:
-#            continue 
-        
-        db_data = db_month_end.copy()
-        
-        # 特殊处理
-        if gp=='aipmchttype':
-            db_data[gp] = db_month_end[gp].map(lambda x: 1 if x==3 else x)
-        
-        if gp=='reloantimes':
-            data_reloan = reloan(db_data, dct_dimension, dct_col, ['data_dt'], ['begin_date'])
-            db_data[gp] = db_month_end[gp].map(lambda x: '首贷' if x==1 else '续贷')
-            
-        #     # 临时增加：首续贷_特例违例
-        #     data_overdue_temp = overdue(db_data, dct_dimension, dct_col, ['reloantimes', 'applysource', 'data_dt'], ['reloantimes', 'applysource', 'loan_pr_scope'])
-        #     with pd.ExcelWriter('风险报表_首续贷_特例违例.xlsx', datetime_format='yyyy年mm月') as writer:
-        #         data_overdue_temp[0].to_excel(writer, sheet_name='逾期不良')
-
-        # 资产情况
-        if gp=='prov_cd':
-            # vintage表取全量数据
-            data_vintage_all = vintage(db_data, dct_dimension, dct_col, [gp])
-            data_vintage_ex_xiamen = vintage(db_data[db_data.prov_cd!='3502'], dct_dimension, dct_col, [gp])
-            
-            # 剩余表只取当月数据
-            db_data = db_month_end[db_month_end.data_dt == db_month_end.data_dt.max()]
+@staged
+def cube(db_data, keys, values=_CUBE_VALUES, buckets=_CUBE_BUCKETS):
+    """汇总立方体：按keys求和一次，字段与明细相同
+    
+    各报表只做求和及阈值条件，立方体可直接代替明细传入overdue、vintage、status_trans等，
+    报表只需上卷立方体，不再扫描明细。keys为_CUBE_FAMILIES中本族的键加上分组维度，须包含报表分组及条件用到的全部字段。
+    """
+    
+    keys = [x for x in dict.fromkeys(keys) if x in db_data.columns]
+    values = [x for x in values if x in db_data.columns]
+    
+    # 分类字段按编码分组：pandas的分类键不支持保留空值分组
+    cols, categories = {}, {}
+    for x in keys:
+        if isinstance(db_data[x].dtype, pd.CategoricalDtype):
+            cols[x], categories[x] = db_data[x].cat.codes.values, db_data[x].cat.categories
+        elif x in buckets:
+            cols[x] = _bucket(db_data[x].values, buckets[x])
         else:
-            data_vintage_all = vintage(db_data, dct_dimension, dct_col, [gp, 'begin_date']) if gp else \
-                               vintage(db_data, dct_dimension, dct_col, ['begin_date'])
-                               
-            data_vintage_ex_xiamen = vintage(db_data[db_data.prov_cd!='3502'], dct_dimension, dct_col, [gp, 'begin_date']) if gp else \
-                                     vintage(db_data[db_data.prov_cd!='3502'], dct_dimension, dct_col, ['begin_date'])
-        
-        # 逾期不良
-        data_overdue = overdue(db_data, dct_dimension, dct_col, [gp, 'data_dt'], [gp, 'loan_pr_scope']) if gp else \
-                       overdue(db_data, dct_dimension, dct_col, ['data_dt'], ['loan_pr_scope'])
+            cols[x] = db_data[x].values
+    for x in values:
+        cols[x] = db_data[x].values
+    
+    result = pd.DataFrame(cols).groupby(keys, dropna=False, sort=False)[values].sum().reset_index()
+    for x, y in categories.items():
+        result[x] = pd.Categorical.from_codes(result[x].values, categories=y, ordered=True)
     
-        # 状态迁徙
-        data_trans = status_trans(db_data, dct_dimension, dct_col, [gp, 'data_dt'], ['cnt', 'od_amt'], ['cnt', 'diff_od_amt']) if gp else \
-                     status_trans(db_data, dct_dimension, dct_col, ['data_dt'], ['cnt', 'od_amt'], ['cnt', 'diff_od_amt'])
+    return(result)
 
-        # 输出
-        str_file_name = '风险月报_' + pd.datetime.today().strftime('%Y%m%d') + ('_' + dct_col[gp] if gp in dct_col else '') + '.xlsx'
+def report_sheets(db_month_end, dct_dimension, dct_col, gp, use_cube=True):
+    """套表各页：依次生成(页名, 表)，各报表族由本族立方体上卷；use_cube为假时直接汇总明细，结果相同"""
+    
+    def _source(data, family):
+        return(cube(data, ([gp] if gp else []) + _CUBE_FAMILIES[family]) if use_cube else data)
+    
+    # 浅拷贝：特殊处理只替换个别维度列，不复制整表数据
+    db_data = db_month_end.copy(deep=False)
+    
+    # 特殊处理：重新映射的维度转为普通取值，按取值排序；有序分类一一映射时仍为分类，会按原编码排序
+    if gp=='aipmchttype':
+        db_data[gp] = db_month_end[gp].map(lambda x: 1 if x==3 else x).astype(object)
+    
+    if gp=='reloantimes':
+        data_reloan = reloan(_source(db_data, 'reloan'), dct_dimension, dct_col, ['data_dt'], ['begin_date'])
+        db_data[gp] = db_month_end[gp].map(lambda x: '首贷' if x==1 else '续贷').astype(object)
         
-        with pd.ExcelWriter(str_file_name, datetime_format='yyyy年mm月') as writer:
-            data_overdue[0].to_excel(writer, sheet_name='逾期不良', startrow=0, startcol=0)
-            data_overdue[1].to_excel(writer, sheet_name='逾期不良', startrow=0, startcol=data_overdue[0].shape[1]+5)
+    #     # 临时增加：首续贷_特例违例
+    #     data_overdue_temp = overdue(db_data, dct_dimension, dct_col, ['reloantimes', 'applysource', 'data_dt'], ['reloantimes', 'applysource', 'loan_pr_scope'])
+    #     with pd.ExcelWriter('风险报表_首续贷_特例违例.xlsx', datetime_format='yyyy年mm月') as writer:
+    #         data_overdue_temp[0].to_excel(writer, sheet_name='逾期不良')
+
+    # 省市：逾期不良、状态迁徙只取当月数据
+    db_last = db_month_end[db_month_end.data_dt == db_month_end.data_dt.max()] if gp=='prov_cd' else db_data
     
-            data_trans[0].to_excel(writer, sheet_name='状态迁徙', startrow=0, startcol=0)
-            data_trans[1].to_excel(writer, sheet_name='状态迁徙', startrow=data_trans[0].shape[0]+5, startcol=0)
+    # 逾期不良
+    data_overdue = overdue(_source(db_last, 'overdue'), dct_dimension, dct_col, [gp, 'data_dt'], [gp, 'loan_pr_scope']) if gp else \
+                   overdue(_source(db_last, 'overdue'), dct_dimension, dct_col, ['data_dt'], ['loan_pr_scope'])
+    yield(('逾期不良', [[data_overdue[0], data_overdue[1]]]))
+
+    # 状态迁徙
+    db_trans = _source(db_last, 'status_trans')
+    data_trans = status_trans(db_trans, dct_dimension, dct_col, [gp, 'data_dt'], ['cnt', 'od_amt'], ['cnt', 'diff_od_amt']) if gp else \
+                 status_trans(db_trans, dct_dimension, dct_col, ['data_dt'], ['cnt', 'od_amt'], ['cnt', 'diff_od_amt'])
+    yield(('状态迁徙', data_trans))
+
+    # 资产情况：vintage表取全量数据，去厦门由全部减去厦门得到
+    data_vintage_all, data_vintage_ex_xiamen = vintage_ex(_source(db_data, 'vintage'), dct_dimension, dct_col, 
+                                                          [gp] if gp=='prov_cd' else [gp, 'begin_date'] if gp else ['begin_date'],
+                                                          ['3502'])
+    yield(('全国资产情况', data_vintage_all))
+    yield(('非厦门资产情况', data_vintage_ex_xiamen))
+
+    if gp=='reloantimes':
+        yield(('续贷历史情况', data_reloan))
+
+def report_set(db_month_end, dct_dimension, dct_col, gp, formats=()):
+    """套表：单个维度的逾期不良、状态迁徙、vintage月报，formats见Workbook"""
+    
+    # 输出：各页计算完即交给后台线程写出，与下一页的计算并行
+    str_file_name = '风险月报_' + pd.Timestamp.today().strftime('%Y%m%d') + ('_' + dct_col[gp] if gp in dct_col else '') + '.xlsx'
+    
+    with Workbook(str_file_name, 'yyyy年mm月', formats) as book:
+        for sheet_name, tables in report_sheets(db_month_end, dct_dimension, dct_col, gp):
+            book.add(sheet_name, tables)
     
-            data_vintage_all[0].to_excel(writer, sheet_name='全国资产情况', startrow=0, startcol=0)
-            data_vintage_all[1].to_excel(writer, sheet_name='全国资产情况', startrow=data_vintage_all[0].shape[0]+5, startcol=0)
+    return(str_file_name)
+
+def _run_job(key):
+    """执行单个报表任务，捕获异常以免影响其他任务"""
+    
+    func, args = _SHARED['jobs'][key]
+    n = len(instrument.records())
+    t0 = time.time()
+    try:
+        with stage(key):
+            func(*args)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
     
-            data_vintage_ex_xiamen[0].to_excel(writer, sheet_name='非厦门资产情况', startrow=0, startcol=0)
-            data_vintage_ex_xiamen[1].to_excel(writer, sheet_name='非厦门资产情况', startrow=data_vintage_ex_xiamen[0].shape[0]+5, startcol=0)
+    # 本任务的运行记录，子进程中执行时交回主进程
+    return((key, time.time() - t0, error, instrument.records()[n:]))
+
+def _job_process(key, conn):
+    """子进程入口：执行任务并把结果交回主进程"""
+    
+    try:
+        conn.send(_run_job(key))
+    finally:
+        conn.close()
+
+def run_jobs(jobs, n_jobs=1):
+    """报表任务调度：jobs为{名称:(函数, 参数)}，每个任务fork一个子进程，最多n_jobs个同时运行；不能fork时串行"""
+    
+    _SHARED['jobs'] = jobs
+    running = {} # 名称:[子进程, 结果管道, 开始时间, 结果]
+    fork = n_jobs > 1 and 'fork' in mp.get_all_start_methods()
+    if fork and threading.active_count() > 1: # 其他线程持有的锁在子进程中永不释放
+        print('报表任务：仍有{0}个其他线程运行，不fork子进程，改为串行'.format(threading.active_count() - 1))
+        fork = False
+    try:
+        if fork:
+            ctx, pending, results = mp.get_context('fork'), list(jobs), []
+            while pending or running:
+                while pending and len(running) < n_jobs:
+                    key = pending.pop(0)
+                    recv, send = ctx.Pipe(duplex=False)
+                    process = ctx.Process(target=_job_process, args=(key, send), name='job:' + key)
+                    process.start()
+                    send.close()
+                    running[key] = [process, recv, time.time(), None]
+                
+                # 先读结果再等子进程退出，避免结果较大时子进程阻塞在管道上
+                waiting = [x[1] for x in running.values() if x[3] is None] + [x[0].sentinel for x in running.values()]
+                ready = wait(waiting)
+                for key, item in list(running.items()):
+                    process, recv, t0, result = item
+                    if process.sentinel not in ready and not (result is None and recv in ready):
+                        continue
+                    if result is None:
+                        try:
+                            item[3] = recv.recv()
+                        except EOFError: # 子进程未交回结果即退出
+                            item[3] = False
+                    if process.sentinel not in ready:
+                        continue
+                    
+                    process.join()
+                    recv.close()
+                    del running[key]
+                    
+                    if item[3]:
+                        key, elapsed, error, records = item[3]
+                        instrument.extend(records)
+                        results.append((key, elapsed, error))
+                    else:
+                        results.append((key, time.time() - t0, '子进程异常退出，退出码{0}'.format(process.exitcode)))
+        else:
+            results = [_run_job(key)[:3] for key in jobs]
+    finally:
+        # 主进程中断时结束仍在运行的子进程
+        for process, recv, *_ in running.values():
+            process.terminate()
+            process.join()
+            recv.close()
+        _SHARED.clear()
+    
+    # 汇总
+    results = sorted(results, key=lambda x: list(jobs).index(x[0]))
+    for key, elapsed, error in results:
+        print('报表任务[{0}]：'.format(key) + ('失败' if error else '完成') + 
+              ('' if elapsed is None else '，用时{0:.1f}秒'.format(elapsed)) + ('\n' + error if error else ''))
+    print('报表任务完成{0}个，失败{1}个'.format(sum(x[2] is None for x in results), sum(x[2] is not None for x in results)))
+    
+    return(results)
+
+def _month_end(store, lst_month, refresh_all, procedure):
+    """重算并拉取月末数据，在后台线程中与周报并行；有月份重算失败时抛出RefreshError，不生成月报"""
+
+    with stage('月末数据'):
+        store.refresh(lst_month, force=refresh_all, procedure=procedure)
+
+        # 获取月末数据：本地缓存缺失或本次重算的月份才从数据库拉取，重算的月份已在refresh中失效
+        return(store.load(lst_month))
+
+#%%
+def main(engine_oracle, dt_begin='20151101', refresh_all=False, pushdown=True, procedure=call_risk_stat_month, n_jobs=None,
+         log_dir='logs', profile=None, formats=()):
+    """周报、投控月报及套表
+    
+    refresh_all为真时全部重算月末快照，有月份重算失败时抛出RefreshError，不输出依赖该快照的报表；
+    pushdown为真时周报在数据库汇总；
+    procedure为重算快照的存储过程，可替换为本地替身；n_jobs为套表进程数，默认为CPU核数。
+    各阶段的耗时、内存记录输出到log_dir；profile为需要cProfile的阶段名，如'vintage'或'套表/省市'。
+    formats为['parquet', 'csv']时各表另存一份供下游使用。
+    """
+    
+    instrument.configure(profile=profile, profile_dir=log_dir)
+    try:
+        with stage('准备'):
+            # 本地快照库：按data_dt分区缓存thbl.risk_statistics_all
+            store = MonthStore(engine_oracle)
+            
+            # 获取字典与数据库已有月份：相互独立，并发查询；字典本地缓存过期才重新读取risk_dimension
+            prepared = run_parallel({'dimension':(load_dimension, (engine_oracle,)), 'remote':(store.remote, ())})
+            dct_dimension = prepared['dimension']
+            
+            dct_col = DCT_COL
+
+        # 月末数据在后台线程中重算、拉取，与周报并行
+        with ThreadPoolExecutor(max_workers=1) as background:
+            #%% 周末报表==============================
+            # 更新最近一个周四的数据，通过参数n调整最近第几个周四
+            with stage('周报'):
+                dt_last_thu = pd.Timestamp.today() - pd.tseries.offsets.Week(n=1, weekday=3, normalize=True)
+                # 周四恰为月末时，重算后本地分区随之失效
+                store.refresh([dt_last_thu], procedure=procedure)
+
+                # 周末数据：pushdown为真时在数据库汇总，只返回汇总结果；否则读取明细在本地汇总
+                if pushdown:
+                    db_week_end = SqlTable(engine_oracle, where=[('data_dt', '==', dt_last_thu)])
+                else:
+                    db_week_end = store.load([dt_last_thu])
+
+                #%% 月末数据==============================
+                # 更新月末数据：可修改refresh_all全部刷新，各月份并发重算、单独提交，各月份分区并行拉取
+                # 与周报汇总查询并行，周报数据就绪后再开始，避免同时写同一分区
+                # 客户端更新全量代码：print('\n'.join(["call RISK_STAT_MONTH('{0}',0);".format(dt.strftime('%Y%m%d')) for dt in lst_month]))
+                lst_month = pd.date_range(dt_begin,pd.Timestamp.today(),freq=pd.offsets.MonthEnd())
+                future_month = background.submit(_month_end, store, lst_month, refresh_all, procedure)
             
-            if gp=='reloantimes':
-                data_reloan[0].to_excel(writer, sheet_name='续贷历史情况', startrow=0, startcol=0)
-                data_reloan[1].to_excel(writer, sheet_name='续贷历史情况', startrow=data_reloan[0].shape[0]+5, startcol=0)
+                # 周末报表
+                overdue_weekly = overdue(db_week_end, dct_dimension, dct_col, ['data_dt'], ['loan_pr_scope'], ['prov_cd'])
+            
+                str_file_name = '风险周报_' + dt_last_thu.strftime('%Y%m%d') + '.xlsx'
+                with Workbook(str_file_name, 'yyyy-mm-dd', formats) as book:
+                    # 各省数据沿用原位置：第5行起，紧接在左侧只有一个日期的汇总表下方
+                    book.write('逾期不良', [(overdue_weekly[0], '逾期不良', 0, 0),
+                                            (overdue_weekly[1], '逾期不良', 0, overdue_weekly[0].shape[1] + GAP),
+                                            (overdue_weekly[2], '逾期不良', GAP, 0)])
+
+            db_month_end = future_month.result()
+
+        # 投控报表：由投控立方体上卷
+        with stage('投控'):
+            db_toukong = cube(db_month_end, _CUBE_FAMILIES['toukong'])
+            toukong_overdue = overdue_toukong(db_toukong, dct_dimension, dct_col, ['data_dt'])
+            toukong_vintage = vintage_toukong(db_toukong, dct_dimension, dct_col, ['begin_date'])
+            
+            str_file_name = '风险月报_' + pd.Timestamp.today().strftime('%Y%m%d') + '_投控.xlsx'
+            with Workbook(str_file_name, 'yyyy年mm月', formats) as book:
+                book.add('逾期不良', [toukong_overdue])
+                book.add('全国30天以下资产情况', [toukong_vintage[0]])
+                book.add('全国30天以上资产情况', [toukong_vintage[1]])
+                book.add('全国90天以上资产情况', [toukong_vintage[2]])
+                book.add('按阶段全国30天以上资产情况', toukong_vintage[3])
+                book.add('按阶段去厦门30天以上资产情况', toukong_vintage[4])
+
+        #%% 套表：各维度报表按进程池并行生成，各报表族的立方体在子进程中汇总
+        with stage('套表'):
+            n_jobs = n_jobs or os.cpu_count()
+            lst_gp = ['', 'aipmchttype', 'loan_period_mon', 'repay_period', 'white', 'applysource', 'reloantimes', 'light', 'prov_cd', 'stage']
+            
+#            # 调试
+#            lst_gp = ['aipmchttype', 'stage']
+    
+            jobs = {dct_col.get(gp, '全部'):(report_set, (db_month_end, dct_dimension, dct_col, gp, formats)) for gp in lst_gp}
+            
+            run_jobs(jobs, n_jobs)
+    finally:
+        # 运行记录：各阶段耗时、内存及行数
+        print('运行记录：' + instrument.dump(os.path.join(log_dir, 'run_' + pd.Timestamp.now().strftime('%Y%m%d_%H%M%S') + '.json')))
+
+if __name__=='__main__':
+    # 连接数据库：共享连接池
+    engine_oracle = get_engine('oracle')
     
-        resize_sheets(str_file_name)
+    main(engine_oracle)
@@ -0,0 +1,24 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# 报表脚本位于仓库根目录
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bench
+import datastore
+
+@pytest.fixture(scope='session')
+def synthetic():
+    """合成月末数据：nan_cols中各字段约5%的行置空，返回明细及编译后的维度字典"""
+
+    def make(seed, nan_cols, n_months=8):
+        db_data, dimension = bench.make_data(600, n_months, 4, seed=seed)
+        rng = np.random.RandomState(seed)
+        for col in nan_cols:
+            db_data.loc[rng.rand(len(db_data)) < 0.05, col] = np.nan
+        return(db_data.reset_index(drop=True), datastore.build_dimension(dimension))
+
+    return(make)
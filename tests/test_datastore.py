@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""数据块合并：结果与pd.concat一致（分类字段统一类别、缺少的字段补空值），逐字段合并时峰值远低于整体合并的两倍"""
+
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import datastore
+
+def _chunk(i, n=1000):
+    rng = np.random.RandomState(i)
+    data = pd.DataFrame({'x':rng.rand(n), 'y':rng.randint(0, 100, n).astype('int8'),
+                         'prov_cd':rng.choice(['3502', '3501', str(3600 + i)], n)})
+    data['prov_cd'] = data.prov_cd.astype('category').cat.as_ordered()
+    data.loc[rng.rand(n) < 0.05, 'prov_cd'] = np.nan
+    return(data)
+
+def test_concat():
+    chunks = [_chunk(i) for i in range(3)]
+    chunks[1] = chunks[1].assign(z=1.0)
+    result = datastore.concat(iter(chunks))
+
+    expected = pd.concat([x.astype({'prov_cd':object}) for x in chunks], ignore_index=True)
+    assert isinstance(result.prov_cd.dtype, pd.CategoricalDtype)
+    assert list(result.prov_cd.cat.categories) == sorted(expected.prov_cd.dropna().unique())
+    pd.testing.assert_frame_equal(result.astype({'prov_cd':object}), expected)
+
+    assert datastore.concat(iter([])).empty
+
+def test_concat_peak():
+    # 字段数与明细表相近；生成数据块本身的临时内存比数据块大得多，按同一模板复制，只计合并占用的内存
+    template = _chunk(0, 20000).join(pd.DataFrame(np.random.RandomState(0).rand(20000, 20)).add_prefix('v'))
+    def chunks():
+        for i in range(10):
+            yield template.copy()
+
+    tracemalloc.start()
+    try:
+        result = datastore.concat(chunks())
+        size, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    # 整体合并时全部数据块与结果同时存在，峰值约为结果的两倍；逐字段合并只多出读入中的数据块及其副本
+    assert len(result) == 200000
+    assert peak < size * 1.5
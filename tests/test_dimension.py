@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""维度字典：字段名小写、省市编码转为字符；本地缓存命中，超过ttl或版本变化时从数据库重建"""
+
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, event, text
+
+import bench
+import datastore
+
+@pytest.fixture
+def engine(tmp_path):
+    """SQLite中的risk_dimension，记录读取该表的次数"""
+
+    engine = create_engine('sqlite:///' + str(tmp_path / 'oracle.db'))
+    bench.make_dimension(4, bench._months(6)).to_sql('risk_dimension', engine, index=False)
+    engine.reads = []
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _count(conn, cursor, statement, *args):
+        if statement.lower().startswith('select') and 'risk_dimension' in statement:
+            engine.reads.append(statement)
+
+    yield engine
+    engine.dispose()
+
+def _rename(engine, name):
+    """修改数据库中厦门的名称，用于区分缓存与重建的结果"""
+    with engine.begin() as conn:
+        conn.execute(text("update risk_dimension set name = :name where dimension = 'PROV_CD' and code = 3502"), {'name':name})
+
+def test_build_dimension(engine):
+    dct_dimension = datastore.build_dimension(pd.read_sql(text('select * from risk_dimension'), engine))
+
+    assert {'prov_cd', 'stage', 'new_loan', 'aipmchttype'} <= set(dct_dimension)
+    assert all(isinstance(x, str) for x in dct_dimension['prov_cd'])
+    assert dct_dimension['prov_cd']['3502'] == '厦门'
+    assert dct_dimension['new_loan'] == {0:'存量贷款', 1:'新增贷款'}
+
+def test_cache_hit(engine, tmp_path):
+    path = str(tmp_path / 'cache' / 'risk_dimension.pkl')
+    built = datastore.load_dimension(engine, path)
+    assert len(engine.reads) == 1
+
+    # 缓存未过期：不读数据库，数据库的修改不可见
+    _rename(engine, '厦门市')
+    assert datastore.load_dimension(engine, path) == built
+    assert len(engine.reads) == 1
+
+def test_rebuild_after_ttl(engine, tmp_path):
+    path = str(tmp_path / 'risk_dimension.pkl')
+    datastore.load_dimension(engine, path)
+    _rename(engine, '厦门市')
+
+    assert datastore.load_dimension(engine, path, ttl=pd.Timedelta(0))['prov_cd']['3502'] == '厦门市'
+    assert len(engine.reads) == 2
+    # 重建后写回缓存
+    assert datastore.load_dimension(engine, path)['prov_cd']['3502'] == '厦门市'
+    assert len(engine.reads) == 2
+
+def test_rebuild_after_version_bump(engine, tmp_path, monkeypatch):
+    path = str(tmp_path / 'risk_dimension.pkl')
+    datastore.load_dimension(engine, path)
+    _rename(engine, '厦门市')
+
+    monkeypatch.setattr(datastore, 'DIMENSION_VERSION', datastore.DIMENSION_VERSION + 1)
+    assert datastore.load_dimension(engine, path)['prov_cd']['3502'] == '厦门市'
+    assert len(engine.reads) == 2
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""首期逾期：归并连接的边界情况，及按状态文件增量运行、TM_LOAN每次运行只读一遍"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, event
+
+import fraud
+
+def _chunks(df, sizes):
+    """按sizes切成数据块"""
+    edges = np.cumsum([0] + list(sizes))
+    return([df.iloc[a:b] for a, b in zip(edges[:-1], edges[1:])])
+
+def _merge(left, right):
+    """一次性连接，按键及两侧值排序以便比较"""
+    result = pd.merge(left, right, on='loan_id')
+    return(result.sort_values(list(result.columns)).reset_index(drop=True))
+
+def test_merge_join_duplicates_across_chunks():
+    # 重复键跨越两侧的数据块边界
+    left = pd.DataFrame({'loan_id':[1, 2, 2, 2, 3, 5, 5], 'a':range(7)})
+    right = pd.DataFrame({'loan_id':[2, 2, 3, 3, 3, 4, 5], 'b':range(7)})
+    expected = _merge(left, right)
+
+    for sizes_left, sizes_right in [([7], [7]), ([2, 2, 3], [1, 3, 3]), ([1] * 7, [2, 5]), ([3, 0, 4], [1] * 7)]:
+        result = pd.concat(fraud.merge_join(_chunks(left, sizes_left), _chunks(right, sizes_right)), ignore_index=True)
+        pd.testing.assert_frame_equal(result.sort_values(list(result.columns)).reset_index(drop=True), expected)
+
+def test_merge_join_random():
+    rng = np.random.RandomState(0)
+    for i in range(20):
+        left = pd.DataFrame({'loan_id':np.sort(rng.randint(0, 30, 60)), 'a':range(60)})
+        right = pd.DataFrame({'loan_id':np.sort(rng.randint(0, 30, 40)), 'b':range(40)})
+        result = pd.concat(fraud.merge_join(_chunks(left, [7] * 8 + [4]), _chunks(right, [3] * 13 + [1])),
+                           ignore_index=True)
+        pd.testing.assert_frame_equal(result.sort_values(list(result.columns)).reset_index(drop=True),
+                                      _merge(left, right))
+
+@pytest.mark.parametrize('keys', [[[1, 3, 2]], [[1, 2], [2, 1]]])
+def test_merge_join_out_of_order(keys):
+    # 块内或跨块键值下降均报错
+    left = [pd.DataFrame({'loan_id':x, 'a':0}) for x in keys]
+    right = [pd.DataFrame({'loan_id':[1, 2, 3], 'b':0})]
+    with pytest.raises(ValueError):
+        list(fraud.merge_join(left, right))
+
+@pytest.fixture
+def engines(tmp_path):
+    """SQLite替身库：TM_LOAN在MySQL替身库，S6700在Oracle替身库；记录读取TM_LOAN的次数"""
+
+    engine_mysql = create_engine('sqlite:///' + str(tmp_path / 'mysql.db'))
+    engine_oracle = create_engine('sqlite:///' + str(tmp_path / 'oracle.db'))
+
+    pd.DataFrame({'loan_id':range(1, 21), 'loan_type':['MCEI'] * 18 + ['XXX'] * 2,
+                  'paid_out_date':[0] * 16 + [20260101] * 4}).to_sql('TM_LOAN', engine_mysql, index=False)
+    # 借据7在1、2日均首期逾期，借据9在2、3日，借据17已结清、借据20非MCEI
+    s6700 = [('2026-10-01', [3, 7, 17]), ('2026-10-02', [7, 9, 12]), ('2026-10-03', [9, 15, 20])]
+    pd.DataFrame([{'loan_id':k, 'data_dt':pd.Timestamp(dt), 'curr_term':1, 'overdue_days':3} for dt, keys in s6700 for k in keys] +
+                 [{'loan_id':5, 'data_dt':pd.Timestamp('2026-10-01'), 'curr_term':2, 'overdue_days':3},
+                  {'loan_id':6, 'data_dt':pd.Timestamp('2026-10-02'), 'curr_term':1, 'overdue_days':0}]
+                 ).to_sql('S6700', engine_oracle, index=False)
+
+    reads = []
+
+    @event.listens_for(engine_mysql, 'before_cursor_execute')
+    def _count(conn, cursor, statement, *args):
+        if 'TM_LOAN' in statement:
+            reads.append(statement)
+
+    yield engine_mysql, engine_oracle, reads
+    engine_mysql.dispose()
+    engine_oracle.dispose()
+
+def test_incremental(engines, tmp_path):
+    engine_mysql, engine_oracle, reads = engines
+    path = str(tmp_path / 'flag')
+
+    # 两个日期一次运行：TM_LOAN只读一遍，借据记在最早首期逾期的日期
+    result = fraud.首期逾期(engine_mysql, engine_oracle, ['2026-10-01', '2026-10-02'], path, chunksize=3)
+    assert len(reads) == 1
+    assert list(zip(result.loan_id, result.data_dt.dt.strftime('%F'))) == \
+           [(3, '2026-10-01'), (7, '2026-10-01'), (9, '2026-10-02'), (12, '2026-10-02')]
+    assert sorted(os.listdir(path)) == ['data_dt=20261001.parquet', 'data_dt=20261002.parquet', 'state.json']
+
+    # 已处理的日期跳过，已标记的借据9不再输出；无新日期时不读数据库
+    result = fraud.首期逾期(engine_mysql, engine_oracle, ['2026-10-01', '2026-10-02', '2026-10-03'], path, chunksize=3)
+    assert len(reads) == 2
+    assert list(zip(result.loan_id, result.data_dt.dt.strftime('%F'))) == [(15, '2026-10-03')]
+    assert len(fraud.首期逾期(engine_mysql, engine_oracle, ['2026-10-03'], path)) == 0
+    assert len(reads) == 2
+
+    with open(os.path.join(path, 'state.json')) as f:
+        assert json.load(f)['dates'] == ['2026-10-01', '2026-10-02', '2026-10-03']
+    flagged = pd.concat(pd.read_parquet(os.path.join(path, x)) for x in sorted(os.listdir(path)) if x.endswith('.parquet'))
+    assert sorted(flagged.loan_id) == [3, 7, 9, 12, 15]
+
+def test_rerun_after_interrupt(engines, tmp_path):
+    # 分区已写但日期未记入状态：重跑时覆盖该分区，借据不会因自身分区而被跳过
+    engine_mysql, engine_oracle, reads = engines
+    path = str(tmp_path / 'flag')
+
+    fraud.首期逾期(engine_mysql, engine_oracle, ['2026-10-01', '2026-10-02'], path)
+    with open(os.path.join(path, 'state.json'), 'w') as f:
+        json.dump({'dates':['2026-10-01']}, f)
+
+    result = fraud.首期逾期(engine_mysql, engine_oracle, ['2026-10-02'], path)
+    assert sorted(result.loan_id) == [9, 12]
+    assert sorted(pd.read_parquet(os.path.join(path, 'data_dt=20261002.parquet')).loan_id) == [9, 12]
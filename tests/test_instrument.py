@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""阶段记录：嵌套路径、异常标记、线程CPU时间，及子进程记录并入主进程"""
+
+import multiprocessing as mp
+import os
+import threading
+import time
+
+import pytest
+
+import instrument
+import templateBisRpt as rpt
+from instrument import stage
+
+def _new(n):
+    """第n条之后新增的记录，按阶段名索引"""
+    return(dict((x['stage'], x) for x in instrument.records()[n:]))
+
+def test_nested_paths():
+    n = len(instrument.records())
+    with stage('外层', data_dt='2026-09-30') as rec:
+        rec['rows_out'] = 3
+        with stage('内层'):
+            with stage('最内层'):
+                pass
+        with stage('内层2'):
+            pass
+
+    # 内层先结束先记录；路径按嵌套关系拼接，附加信息原样保留
+    assert [x['stage'] for x in instrument.records()[n:]] == ['外层/内层/最内层', '外层/内层', '外层/内层2', '外层']
+    outer = _new(n)['外层']
+    assert outer['data_dt'] == '2026-09-30' and outer['rows_out'] == 3
+    assert outer['pid'] == os.getpid() and 'error' not in outer
+
+def test_thread_stack():
+    # 各线程的阶段栈独立，其他线程中的阶段不嵌套在主线程的阶段下
+    n = len(instrument.records())
+    with stage('主线程'):
+        def _worker():
+            with stage('子线程'):
+                pass
+        thread = threading.Thread(target=_worker, name='worker')
+        thread.start()
+        thread.join()
+
+    records = _new(n)
+    assert set(records) == {'主线程', '子线程'}
+    assert records['子线程']['thread'] == 'worker'
+
+def test_error_marked():
+    n = len(instrument.records())
+    with pytest.raises(ValueError):
+        with stage('外层'):
+            with stage('出错'):
+                raise ValueError('出错')
+
+    # 异常照常抛出，所在阶段及外层均标记error，栈已恢复
+    records = _new(n)
+    assert records['外层/出错']['error'] and records['外层']['error']
+    with stage('之后'):
+        pass
+    assert instrument.records()[-1]['stage'] == '之后'
+
+def test_thread_cpu():
+    # cpu只计本线程：主线程等待期间其他线程占用的CPU只计入cpu_process
+    stop = threading.Event()
+    def _spin():
+        while not stop.is_set():
+            sum(range(1000))
+    thread = threading.Thread(target=_spin)
+    n = len(instrument.records())
+    with stage('等待'):
+        thread.start()
+        time.sleep(0.3)
+        stop.set()
+        thread.join()
+
+    rec = _new(n)['等待']
+    assert rec['cpu'] < 0.1 < rec['cpu_process']
+    assert rec['wall'] >= 0.3
+
+def _job():
+    with stage('内层') as rec:
+        rec['rows_out'] = 1
+
+@pytest.mark.skipif('fork' not in mp.get_all_start_methods(), reason='平台不支持fork')
+def test_fork_pool_records():
+    # 子进程中的记录随结果交回主进程，路径以任务名开头
+    n = len(instrument.records())
+    rpt.run_jobs({'任务a':(_job, ()), '任务b':(_job, ())}, n_jobs=2)
+
+    records = _new(n)
+    assert set(records) == {'任务a', '任务a/内层', '任务b', '任务b/内层'}
+    assert all(x['pid'] != os.getpid() for x in records.values())
+    assert records['任务a']['pid'] != records['任务b']['pid']
+    assert records['任务b/内层']['rows_out'] == 1
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""报表任务调度：任务抛出异常或子进程异常退出只记该任务失败，其他任务照常输出"""
+
+import multiprocessing as mp
+import os
+import threading
+
+import pytest
+
+import instrument
+import templateBisRpt as rpt
+
+pytestmark = pytest.mark.skipif('fork' not in mp.get_all_start_methods(), reason='平台不支持fork')
+
+def _write(path):
+    """正常任务：写出进程号"""
+    with open(path, 'w') as f:
+        f.write(str(os.getpid()))
+
+def _raise():
+    raise ValueError('任务出错')
+
+def _exit():
+    os._exit(3)
+
+def test_failures_isolated(tmp_path):
+    files = [str(tmp_path / '{0}.txt'.format(i)) for i in range(3)]
+    jobs = {'a':(_write, (files[0],)), '出错':(_raise, ()), 'b':(_write, (files[1],)), '退出':(_exit, ()),
+            'c':(_write, (files[2],))}
+    n = len(instrument.records())
+    results = rpt.run_jobs(jobs, n_jobs=2)
+
+    # 汇总按任务顺序，异常及异常退出只影响各自的任务
+    assert [x[0] for x in results] == list(jobs)
+    errors = dict((x[0], x[2]) for x in results)
+    assert 'ValueError: 任务出错' in errors['出错']
+    assert '退出码3' in errors['退出']
+    assert [errors[x] for x in 'abc'] == [None] * 3
+
+    # 其他任务在子进程中完成输出，运行记录交回主进程
+    for x in files:
+        with open(x) as f:
+            assert int(f.read()) != os.getpid()
+    stages = [x['stage'] for x in instrument.records()[n:]]
+    assert sorted(stages) == ['a', 'b', 'c', '出错']
+    assert not rpt._SHARED
+
+def test_serial_with_threads(tmp_path):
+    # 仍有其他线程运行时不fork，任务在主进程中串行执行
+    stop = threading.Event()
+    thread = threading.Thread(target=stop.wait)
+    thread.start()
+    try:
+        results = rpt.run_jobs({'a':(_write, (str(tmp_path / 'a.txt'),)), '出错':(_raise, ())}, n_jobs=2)
+    finally:
+        stop.set()
+        thread.join()
+
+    assert [x[2] is None for x in results] == [True, False]
+    with open(str(tmp_path / 'a.txt')) as f:
+        assert int(f.read()) == os.getpid()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""_patch：插入缺失月份、对角线补零、左移对齐及列名，与原逐列实现的口径一致"""
+
+import numpy as np
+import pandas as pd
+
+import templateBisRpt as rpt
+
+nan = np.nan
+
+def _pivot(rows, months, values, index=None):
+    """放款月份×数据月份的透视表"""
+    index = pd.DatetimeIndex(rows, name='begin_date') if index is None else index
+    return(pd.DataFrame(values, index=index, columns=pd.DatetimeIndex(months, name='data_dt')))
+
+def test_diagonal_fill_and_shift():
+    # 2015-09放款当月无数据：对角线补零；2015-10整列缺失：放款后补零，放款前为空；各行按首个有效月份左移
+    df = _pivot(['2015-08-31', '2015-09-30', '2015-11-30'], ['2015-08-31', '2015-09-30', '2015-11-30'],
+                [[1, 2, 3], [nan, nan, 6], [nan, nan, 9]])
+    result = rpt._patch(df, '2015-08-31')
+
+    assert list(result.columns[:4]) == ['第0个月', '第1个月', '第2个月', '第3个月']
+    np.testing.assert_array_equal(result.iloc[:, :4].values, [[1, 2, 0, 3], [0, 0, 6, 0], [9, 0, 0, 0]])
+
+    # 左移后行尾为空，空列数即放款月份相对首列的月数
+    assert result.iloc[0].notnull().all()
+    assert result.iloc[1, -1:].isnull().all() and result.iloc[1, :-1].notnull().all()
+    assert result.iloc[2, -3:].isnull().all() and result.iloc[2, :-3].notnull().all()
+
+def test_diagonal_fill_stops_at_missing_cohort():
+    # 2015-09放款月份没有行：补零到此为止，2015-10放款当月仍为空，首个有效月份左移到第0个月
+    df = _pivot(['2015-08-31', '2015-10-31'], ['2015-08-31', '2015-09-30', '2015-10-31', '2015-11-30'],
+                [[nan, 2, 3, 4], [nan, nan, nan, 8]])
+    result = rpt._patch(df, '2015-08-31')
+
+    np.testing.assert_array_equal(result.iloc[:, :4].values, [[0, 2, 3, 4], [8, 0, 0, 0]])
+
+def test_no_fill_for_multiindex():
+    # 多层行标题不补零：放款当月为空的分组从次月起对齐
+    index = pd.MultiIndex.from_tuples([('a', pd.Timestamp('2015-08-31')), ('b', pd.Timestamp('2015-08-31'))],
+                                      names=['light', 'begin_date'])
+    df = _pivot(None, ['2015-08-31', '2015-09-30'], [[1, 2], [nan, 4]], index)
+    result = rpt._patch(df, '2015-08-31')
+
+    assert result.index.equals(index)
+    np.testing.assert_array_equal(result.iloc[:, :2].values, [[1, 2], [4, 0]])
+
+def test_labels_relative_to_dt_start():
+    # 月份列自VINTAGE_START起，列名按相对最早放款日期的月数计算；没有2015-08放款月份的行，不补零
+    df = _pivot(['2016-01-31', '2016-02-29'], ['2016-01-31', '2016-02-29'], [[nan, 1], [nan, 2]])
+    result = rpt._patch(df, '2016-01-31')
+
+    months = pd.date_range(rpt.VINTAGE_START, pd.Timestamp.today(), freq=pd.offsets.MonthEnd())
+    assert len(result.columns) == len(months)
+    assert list(result.columns[:6]) == ['第-5个月', '第-4个月', '第-3个月', '第-2个月', '第-1个月', '第0个月']
+    np.testing.assert_array_equal(result.iloc[:, :2].values, [[1, 0], [2, 0]])
+
+def test_idx_dates():
+    # 行标题不是日期时按idx_dates判断放款月份，不补对角线
+    df = _pivot(None, ['2015-08-31', '2015-10-31'], [[nan, 2], [nan, 3]], pd.Index([1, 2], name='stage'))
+    result = rpt._patch(df, '2015-08-31', pd.DatetimeIndex(['2015-08-31', '2015-09-30']))
+
+    np.testing.assert_array_equal(result.iloc[:, :3].values, [[0, 2, 0], [0, 3, 0]])
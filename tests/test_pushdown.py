@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""汇总下推（SqlTable）与本地pandas汇总结果一致"""
+
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, text
+
+import datastore
+import templateBisRpt as rpt
+
+@pytest.fixture(scope='module')
+def backends(synthetic, tmp_path_factory):
+    """同一份合成数据：本地DataFrame及SQLite中的同名表，分组键及状态字段含空值"""
+
+    db_data, dct_dimension = synthetic(1, ['loan_pr_scope', 'prov_cd', 'stage', 'overdue_status_3', 'reloantimes', 'new_maturity_days'])
+
+    # 分类字段按原始取值入库，与数据库中的字段类型一致
+    engine = create_engine('sqlite:///' + str(tmp_path_factory.mktemp('pushdown') / 'oracle.db'))
+    raw = db_data.copy()
+    for col in raw.columns[raw.dtypes == 'category']:
+        raw[col] = np.asarray(raw[col], dtype=object)
+    raw.to_sql('risk_statistics_all', engine, index=False)
+
+    # 本地明细与pushdown=False时相同，由数据库读回并按schema压缩
+    db_data = datastore.read_sql(text('select * from risk_statistics_all'), engine, parse_dates=['data_dt', 'begin_date'])
+
+    return(db_data, engine, dct_dimension)
+
+def _cases(dct_dimension):
+    dct_col = rpt.DCT_COL
+    return({'overdue':lambda x: rpt.overdue(x, dct_dimension, dct_col, ['data_dt'], ['loan_pr_scope'], ['prov_cd']),
+            'overdue_keys':lambda x: rpt.overdue(x, dct_dimension, dct_col, ['stage', 'data_dt'], ['prov_cd', 'loan_pr_scope']),
+            'overdue_toukong':lambda x: [rpt.overdue_toukong(x, dct_dimension, dct_col, ['data_dt'])],
+            'overdue_toukong_keys':lambda x: [rpt.overdue_toukong(x, dct_dimension, dct_col, ['prov_cd', 'data_dt'])],
+            'reloan':lambda x: rpt.reloan(x, dct_dimension, dct_col, ['data_dt'], ['begin_date']),
+            'reloan_keys':lambda x: rpt.reloan(x, dct_dimension, dct_col, ['stage', 'data_dt'], ['stage', 'begin_date'])})
+
+@pytest.mark.parametrize('case', ['overdue', 'overdue_keys', 'overdue_toukong', 'overdue_toukong_keys', 'reloan', 'reloan_keys'])
+@pytest.mark.parametrize('snapshot', [False, True])
+def test_pushdown_parity(backends, case, snapshot):
+    db_data, engine, dct_dimension = backends
+    func = _cases(dct_dimension)[case]
+
+    # snapshot为真时只取最近一个月，与周报相同
+    where = [('data_dt', '==', db_data.data_dt.max())] if snapshot else []
+    local = db_data[db_data.data_dt == db_data.data_dt.max()] if snapshot else db_data
+    remote = datastore.SqlTable(engine, table='risk_statistics_all', where=where)
+
+    expected, result = func(local), func(remote)
+    assert len(expected) == len(result)
+    for x, y in zip(expected, result):
+        if x is None:
+            assert y is None
+            continue
+        assert len(x)
+        pd.testing.assert_frame_equal(x, y, check_dtype=False, check_index_type=False, check_categorical=False,
+                                      check_exact=False)
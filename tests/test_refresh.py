@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""快照重算：部分月份失败时抛出RefreshError，成功重算的月份不再沿用本地旧分区"""
+
+import pandas as pd
+import pytest
+from sqlalchemy import DateTime, bindparam, text
+
+import bench
+import datastore
+
+@pytest.fixture
+def oracle(tmp_path):
+    """SQLite替身库及本地快照库，前三个月已缓存为本地分区"""
+
+    engine, procedure, dt_begin = bench.fake_oracle(str(tmp_path / 'db'), 200, 4, 3, seed=2)
+    store = datastore.MonthStore(engine, path=str(tmp_path / 'cache'))
+    months = sorted(store.remote())
+    store.load(months)
+    assert store.cached() == set(months)
+
+    yield engine, procedure, store, months
+    engine.dispose()
+
+def test_refresh_failure(oracle):
+    engine, procedure, store, months = oracle
+    bad, calls = months[1], []
+
+    def _procedure(conn, dt):
+        """替身过程：bad月份每次都失败，其余月份重算后户数改为2，以区分旧分区"""
+        calls.append(pd.Timestamp(dt))
+        if pd.Timestamp(dt) == bad:
+            raise RuntimeError('ORA-00060')
+        procedure(conn, dt)
+        conn.execute(text('update thbl.risk_statistics_all set cnt = 2 where data_dt = :data_dt').bindparams(
+                bindparam('data_dt', type_=DateTime)), {'data_dt':pd.Timestamp(dt).to_pydatetime()})
+
+    with pytest.raises(datastore.RefreshError) as info:
+        store.refresh(months, force=True, procedure=_procedure, retries=2, wait=0)
+
+    # 失败月份重试retries次后列入failed，其余月份照常重算
+    assert list(info.value.failed) == [bad]
+    assert 'ORA-00060' in info.value.failed[bad]
+    assert info.value.refreshed == [x for x in months if x != bad]
+    assert calls.count(bad) == 3
+
+    # 成功重算的月份已删除本地分区，失败月份的数据库快照未变，保留分区
+    assert store.cached() == {bad}
+
+    # 下次运行（不重算）时重新拉取成功重算的月份，不会读到旧分区
+    store = datastore.MonthStore(engine, path=store.path)
+    assert store.refresh(months, procedure=_procedure) == []
+    data = store.load(months)
+    cnt = data.groupby('data_dt').cnt.max()
+    assert cnt[bad] == 1
+    assert (cnt.drop(bad) == 2).all()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""报表查询服务：结果缓存的命中、淘汰及重新加载，查询与直接出表一致，过滤条件按取值比较，输入错误返回400，查询不保留阶段记录"""
+
+import json
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import bench
+import datastore
+import instrument
+import service
+import templateBisRpt as rpt
+
+OVERDUE = {'gp_keys_all':['light', 'data_dt'], 'gp_keys_last':['light', 'loan_pr_scope']}
+
+@pytest.fixture
+def svc(tmp_path, monkeypatch):
+    """SQLite替身库上的服务，缓存2个结果；维度字典缓存写在临时目录"""
+
+    monkeypatch.chdir(tmp_path)
+    engine, procedure, dt_begin = bench.fake_oracle(str(tmp_path / 'db'), 200, 4, 3, seed=3)
+    yield service.ReportService(engine, dt_begin, datastore.MonthStore(engine, path=str(tmp_path / 'cache')), maxsize=2)
+    engine.dispose()
+
+def _assert_tables(expected, result):
+    expected, result = service._tables(expected), service._tables(result)
+    assert len(expected) == len(result) and len(expected)
+    for x, y in zip(expected, result):
+        pd.testing.assert_frame_equal(x, y, check_dtype=False, check_index_type=False, check_categorical=False,
+                                      check_exact=False)
+
+def test_cache_hit_and_eviction(svc):
+    result, cached = svc.query('overdue', **OVERDUE)
+    assert not cached
+    again, cached = svc.query('overdue', **OVERDUE)
+    assert cached and again is result
+
+    # 按LRU淘汰：命中的结果移到最后，超出maxsize时淘汰最久未用的
+    svc.query('vintage', gp_keys_all=['begin_date'])
+    svc.query('overdue', **OVERDUE)
+    svc.query('vintage', gp_keys_all=['light', 'begin_date'])
+    assert len(svc._cache) == 2
+    assert svc.query('overdue', **OVERDUE)[1]
+    assert not svc.query('vintage', gp_keys_all=['begin_date'])[1]
+
+    # 过滤条件不同不命中
+    assert not svc.query('overdue', [('prov_cd', '!=', '3502')], **OVERDUE)[1]
+
+def test_reload(svc, monkeypatch):
+    svc.query('overdue', **OVERDUE)
+    version = svc.version
+    assert svc.reload() != version
+    assert not svc.query('overdue', **OVERDUE)[1]
+
+    # 计算期间重新加载：结果按旧数据算出，不缓存
+    def _reloading(db_data, dct_dimension, dct_col):
+        svc.reload()
+        return(rpt.overdue(db_data, dct_dimension, dct_col, **OVERDUE))
+
+    monkeypatch.setitem(service.FUNCS, 'reloading', (_reloading, {}))
+    assert not svc.query('reloading')[1]
+    assert not svc.query('overdue', **OVERDUE)[1]
+    assert all(x[0] != 'reloading' for x in svc._cache)
+
+@pytest.mark.parametrize('func,kwargs,where', [('overdue', OVERDUE, []),
+                                               ('overdue', OVERDUE, [('prov_cd', '!=', '3502')]),
+                                               ('vintage', {'gp_keys_all':['light', 'begin_date']}, []),
+                                               ('vintage_ex', {'gp_keys_all':['begin_date'], 'ex_prov':['3502']}, []),
+                                               ('status_trans', {'index_values':['light', 'data_dt'],
+                                                                 'pivot_values_all':['cnt', 'od_amt'],
+                                                                 'pivot_values_trans':['cnt', 'diff_od_amt']}, [])])
+def test_query_matches_report(svc, func, kwargs, where):
+    data = svc.db_month_end[rpt._mask(svc.db_month_end, where)] if where else svc.db_month_end
+    expected = service.FUNCS[func][0](data, svc.dct_dimension, rpt.DCT_COL, **kwargs)
+    _assert_tables(expected, svc.query(func, where, **kwargs)[0])
+
+def test_where(svc):
+    # 分类字段按取值比较：界值不是已有类别时也可比较
+    kwargs, where = svc.parse('overdue', {'where':['loan_period_mon>7', 'loan_period_mon<=24'],
+                                          'gp_keys_all':['light,data_dt'], 'gp_keys_last':['light,loan_pr_scope']})
+    assert where == [('loan_period_mon', '>', 7.0), ('loan_period_mon', '<=', 24.0)]
+    period = np.asarray(svc.db_month_end.loan_period_mon, dtype=float)
+    data = svc.db_month_end[(period > 7) & (period <= 24)]
+    assert 0 < len(data) < len(svc.db_month_end)
+    _assert_tables(rpt.overdue(data, svc.dct_dimension, rpt.DCT_COL, **OVERDUE), svc.query('overdue', where, **kwargs)[0])
+
+    # 无法转换或比较的取值为ValueError，HTTP接口返回400
+    with pytest.raises(ValueError):
+        svc.parse('overdue', {'where':['loan_period_mon>abc']})
+    with pytest.raises(ValueError):
+        svc.query('overdue', [('loan_period_mon', '>', 'abc')], **OVERDUE)
+
+    # 缺少报表函数的必需参数为KeyError，不进入报表函数
+    with pytest.raises(KeyError, match='gp_keys_last'):
+        svc.query('overdue', gp_keys_all=['data_dt'])
+
+@pytest.mark.parametrize('path', ['/overdue?gp_keys_all=data_dt', '/overdue?gp_keys_all=data_dt&gp_keys_last=loan_pr_scope&where=loan_period_mon>abc',
+                                  '/overdue?gp_keys_all=data_dt&gp_keys_last=loan_pr_scope&where=x>1', '/unknown', '/vintage?gp=light'])
+def test_bad_request(svc, monkeypatch, path):
+    # 缺少参数、过滤条件无法识别或比较、未知的函数及参数均为400
+    monkeypatch.setattr(service.Handler, 'service', svc)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), service.Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        with pytest.raises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen('http://127.0.0.1:{0}{1}'.format(server.server_port, path))
+        assert e.value.code == 400 and json.loads(e.value.read())['error']
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_no_records_from_queries(svc):
+    # 查询期间只在本线程关闭记录，之后及其他流程照常记录
+    n = len(instrument.records())
+    svc.query('overdue', **OVERDUE)
+    assert len(instrument.records()) == n
+
+    with instrument.stage('其他流程'):
+        pass
+    assert [x['stage'] for x in instrument.records()[n:]] == ['其他流程']
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""状态迁徙表：与原实现（先翻译明细再透视）的结果一致，含标签排序及翻译为同一名称的合并"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import templateBisRpt as rpt
+
+VALUES_ALL, VALUES_TRANS = ['cnt', 'od_amt'], ['cnt', 'diff_od_amt']
+
+def _baseline(db_data, dct_dimension, dct_col, index_values, pivot_values_all, pivot_values_trans):
+    """原实现：明细按维度翻译后逐个透视"""
+
+    db_data = db_data.apply(lambda x: x.map(dct_dimension[x.name])
+                            if x.name in dct_dimension and 9999 not in dct_dimension[x.name] else x)
+
+    dfs_all = [db_data.pivot_table(values=pivot_values_all, index=index_values, columns=[x], aggfunc='sum')
+               for x in ['new_loan', 'overdue_status_5', 'overdue_status_3']]
+    data_all = pd.concat(dfs_all, axis=1)[pivot_values_all].fillna(0)
+    data_all.columns.set_names([None,None], inplace =True)
+    data_all.rename(columns=dct_col, level=0, inplace=True)
+
+    db_data['trans_nl_od'] = db_data.new_loan + '-' + db_data.overdue_status_3
+    db_data['trans_od_3'] = db_data.overdue_status_3_last + '-' + db_data.overdue_status_3
+    db_data['trans_od_5'] = db_data.overdue_status_5_last + '-' + db_data.overdue_status_5
+    db_data['trans_status'] = db_data.status_last_month + '-' + db_data.status_this_month
+
+    def pivot(col, labels):
+        """按标签顺序选列，未出现的迁徙不出列（原实现在pandas 1.x下.loc忽略缺失标签）；列层名置空：新版pandas中层名不同的表不能相减"""
+        result = db_data.pivot_table(values=pivot_values_trans, index=index_values, columns=[col], aggfunc='sum')
+        present = set(result.columns.get_level_values(1))
+        return(result.reindex(columns=pd.MultiIndex.from_product([pivot_values_trans, [x for x in labels if x in present]])))
+    trans_1, trans_2, trans_3, trans_4 = [pivot(col, labels) for col, (_, _, labels) in
+                                          zip(['trans_nl_od', 'trans_od_3', 'trans_od_5', 'trans_status'], rpt._TRANS)]
+
+    temp_index = trans_2.index if len(trans_2) > len(trans_4) else trans_4.index
+    select = lambda df, label: df.reindex(index=temp_index, columns=pd.MultiIndex.from_product([pivot_values_trans, [label]]))
+    trans_5 = (select(trans_2, '逾期-逾期').rename(columns={'逾期-逾期':'正常出账'}) -
+               select(trans_4, '活动状态(active)-终止(terminate)').rename(columns={'活动状态(active)-终止(terminate)':'正常出账'}))
+    data_trans = pd.concat([trans_1, trans_2, trans_3, trans_4, trans_5], axis=1)[pivot_values_trans].fillna(0)
+    data_trans.columns.set_names([None,None], inplace =True)
+    data_trans.rename(columns=dct_col, level=0, inplace=True)
+
+    return([rpt._translate(data_all, dct_dimension, dct_col), rpt._translate(data_trans, dct_dimension, dct_col)])
+
+@pytest.fixture(scope='module')
+def data(synthetic):
+    """合成月末数据，状态字段含空值；原实现按对象类型的明细计算"""
+    return(synthetic(5, ['light', 'overdue_status_3', 'overdue_status_5_last', 'status_this_month']))
+
+def _merged(dct_dimension):
+    """维度字典中不同编码翻译为同一名称：新增、存量贷款均为新增贷款，红、黄灯均为红"""
+    dct = dict(dct_dimension)
+    dct['new_loan'] = dict((k, '新增贷款') for k in dct['new_loan'])
+    dct['light'] = {**dct['light'], 2:dct['light'][1]}
+    return(dct)
+
+@pytest.mark.parametrize('merged', [False, True])
+@pytest.mark.parametrize('index_values', [['data_dt'], ['light', 'data_dt'], ['light', 'white', 'data_dt']])
+def test_parity(data, index_values, merged):
+    db_data, dct_dimension = data
+    dct_dimension = _merged(dct_dimension) if merged else dct_dimension
+
+    raw = db_data.copy()
+    for col in raw.columns[raw.dtypes == 'category']:
+        raw[col] = np.asarray(raw[col], dtype=object)
+    expected = _baseline(raw, dct_dimension, rpt.DCT_COL, index_values, VALUES_ALL, VALUES_TRANS)
+    result = rpt.status_trans(db_data, dct_dimension, rpt.DCT_COL, index_values, VALUES_ALL, VALUES_TRANS)
+
+    for x, y in zip(expected, result):
+        # 行、列标题的顺序与原实现一致
+        assert list(x.index) == list(y.index) and list(x.index.names) == list(y.index.names)
+        assert list(x.columns) == list(y.columns)
+        np.testing.assert_allclose(x.values.astype(float), y.values.astype(float))
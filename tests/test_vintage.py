@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""vintage_ex：全部减去剔除省市得到的表，与剔除明细后重新汇总的结果一致"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import bench
+import datastore
+import templateBisRpt as rpt
+
+@pytest.fixture(scope='module')
+def data():
+    """合成月末数据：最后数据月份中有一组非厦门金额全部为0
+
+    该组厦门的最后两笔金额之后还有非厦门为0的行，分组求和的补偿项使全部汇总与厦门汇总相差约1e-11，相减后不是精确的0。
+    """
+
+    db_data, dimension = bench.make_data(300, 6, 4, seed=3)
+    db_data = db_data.reset_index(drop=True)
+    xiamen = (db_data.prov_cd.astype(str) == '3502').values
+
+    dt = db_data.data_dt.max()
+    for begin_date in sorted(db_data.begin_date.unique()):
+        rows = np.flatnonzero((db_data.data_dt == dt).values & (db_data.begin_date == begin_date).values)
+        pos = rows[xiamen[rows]]
+        if len(pos) >= 2 and (rows > pos[-1]).any():
+            break
+    for col in ['od_amt', 'od_amt_30', 'loan_pr']:
+        db_data.loc[rows, col] = 0.
+        db_data.loc[pos[-2:], col] = [37541.1, 75390.2]
+
+    return(db_data, datastore.build_dimension(dimension), xiamen)
+
+@pytest.mark.parametrize('gp_keys_all,gp_value', [(['begin_date'], 'od_amt'),
+                                                  (['light', 'begin_date'], 'od_amt'),
+                                                  (['prov_cd'], 'od_amt'),
+                                                  (['stage', 'begin_date'], 'od_amt_30')])
+def test_vintage_ex(data, gp_keys_all, gp_value):
+    db_data, dct_dimension, xiamen = data
+    result = rpt.vintage_ex(db_data, dct_dimension, rpt.DCT_COL, gp_keys_all, ['3502'], gp_value)
+
+    assert len(result) == 2
+    for expected, x in zip([rpt.vintage(db_data, dct_dimension, rpt.DCT_COL, gp_keys_all, gp_value),
+                            rpt.vintage(db_data[~xiamen], dct_dimension, rpt.DCT_COL, gp_keys_all, gp_value)], result):
+        assert len(expected) == len(x) == 2
+        for y, z in zip(expected, x):
+            pd.testing.assert_frame_equal(y, z, check_categorical=False, check_exact=False)
+            # 为0及为空的位置与重新汇总完全一致，不留相减的浮点误差
+            assert ((y == 0) == (z == 0)).all().all()
+            assert (y.isnull() == z.isnull()).all().all()
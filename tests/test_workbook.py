@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""工作簿输出：写出后读回单元格及合并区域，与逐个DataFrame.to_excel的结果一致"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+openpyxl = pytest.importorskip('openpyxl')
+
+import workbook
+from workbook import Workbook
+
+@pytest.fixture
+def tables():
+    """多层行标题及列标题的表、单层表，含空值及日期"""
+
+    index = pd.MultiIndex.from_product([['红', '绿'], pd.to_datetime(['2026-07-31', '2026-08-31', '2026-09-30'])],
+                                       names=['灯', '数据日期'])
+    columns = pd.MultiIndex.from_product([['户数', '金额'], ['逾期', '非逾期']])
+    wide = pd.DataFrame(np.arange(24, dtype=float).reshape(6, 4), index=index, columns=columns)
+    wide.iloc[1, 2] = np.nan
+    small = pd.DataFrame({'户数':[1, 2], '比例':[0.5, np.nan]}, index=pd.Index(['a', 'b'], name='省份'))
+    tall = pd.DataFrame({'金额':np.arange(8.)}, index=pd.Index(range(8), name='阶段'))
+
+    return(wide, small, tall)
+
+def _read(path, sheet_name):
+    """读回单元格取值（非空）及合并区域"""
+    sheet = openpyxl.load_workbook(path)[sheet_name]
+    cells = dict(((x.row, x.column), x.value) for row in sheet.iter_rows() for x in row if x.value is not None)
+    return(cells, set(str(x) for x in sheet.merged_cells.ranges))
+
+def _horizontal(merges):
+    """同一行内的合并区域"""
+    return(set(x for x in merges if openpyxl.utils.cell.range_boundaries(x)[1] == openpyxl.utils.cell.range_boundaries(x)[3]))
+
+def test_round_trip(tables, tmp_path):
+    wide, small, tall = tables
+    path, expected = str(tmp_path / 'book.xlsx'), str(tmp_path / 'expected.xlsx')
+
+    with Workbook(path, 'yyyy-mm-dd') as book:
+        book.add('排版', [[wide, small], tall])
+        book.write('定位', [(small, '定位', 0, 0), (tall, '定位', 5, 0)])
+
+    # 排版的位置：右侧的表按左侧数据列数+5，下方的表按上方最高的表数据行数+5
+    positions = [(x[2], x[3]) for x in workbook.layout('排版', [[wide, small], tall])]
+    assert positions == [(0, 0), (0, wide.shape[1] + 5), (wide.shape[0] + 5, 0)]
+
+    with pd.ExcelWriter(expected, engine='openpyxl') as writer:
+        for (df, startrow, startcol) in zip(tables, *zip(*positions)):
+            df.to_excel(writer, sheet_name='排版', startrow=startrow, startcol=startcol)
+        small.to_excel(writer, sheet_name='定位', startrow=0, startcol=0)
+        tall.to_excel(writer, sheet_name='定位', startrow=5, startcol=0)
+
+    for sheet_name in ['排版', '定位']:
+        cells, merges = _read(path, sheet_name)
+        cells_expected, merges_expected = _read(expected, sheet_name)
+
+        # 单元格取值一致；跨行的行标题只在首行写值，与to_excel合并后读回的结果相同
+        assert cells == cells_expected
+        # 同一行内的表头合并一致，跨行合并以边框代替，不登记为合并区域
+        assert merges == _horizontal(merges_expected)
+
+    cells, merges = _read(path, '排版')
+    assert cells[(1, 3)] == '户数' and 'C1:D1' in merges
+    assert cells[(4, 1)] == '红' and (5, 1) not in cells and (7, 1) in cells
+    assert cells[(wide.shape[0] + 6, 1)] == '阶段'
+
+def test_col_widths(tables, tmp_path):
+    wide, small, _ = tables
+    wide = wide.copy()
+    wide.iloc[0, 0] = 1234567.5
+
+    # 中日韩及全角字符按2个字符计
+    assert workbook._text_width('厦门A1') == 6
+    assert workbook._text_width('ＡＢ') == 4
+
+    # 行标题：灯、日期按yyyy年mm月显示（2026年07月）；数据列：两层列标题及取值中的最宽者
+    assert workbook._col_widths(wide, 'yyyy年mm月') == [2, 10, 9, 6, 4, 6]
+    assert workbook._col_widths(wide, 'yyyy-mm-dd') == [2, 10, 9, 6, 4, 6]
+    assert workbook._col_widths(wide, 'yyyy-mm') == [2, 8, 9, 6, 4, 6]
+    assert workbook._col_widths(small, 'yyyy年mm月') == [4, 4, 4]
+
+    # 同一列取左右、上下各表中的最宽者，另加2
+    path = str(tmp_path / 'book.xlsx')
+    with Workbook(path, 'yyyy年mm月') as book:
+        book.add('宽度', [wide, small])
+    sheet = openpyxl.load_workbook(path)['宽度']
+    widths = [sheet.column_dimensions[openpyxl.utils.get_column_letter(i + 1)].width for i in range(6)]
+    assert widths == pytest.approx([6, 12, 11, 8, 6, 8], abs=1)
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""报表工作簿输出：声明式排版，后台线程逐行流式写入
+
+    with Workbook('风险月报.xlsx', 'yyyy年mm月', formats=['parquet']) as book:
+        book.add('逾期不良', [[data_all, data_last], data_prov])
+        book.add('状态迁徙', [data_trans_all, data_trans])
+
+每页由若干行组成，自上而下排列；一行中的多个表左右并排，表间隔GAP行或列。
+add只把表放入队列即返回，工作簿在后台线程中按页写出，计算下一张表与写出上一张并行。
+工作簿以xlsxwriter的constant_memory模式逐行写出：各表按行生成单元格，除日期列的转换外不展开整表，
+跨行合并的行标题在首行写值、以边框连成一格（该模式下无法登记跨行合并）；
+formats中的parquet、csv另把各表写入与工作簿同名的目录，供下游使用。
+"""
+
+import datetime
+import heapq
+import os
+import queue
+import threading
+import unicodedata
+
+import numpy as np
+import pandas as pd
+import xlsxwriter
+
+from instrument import rows, stage
+
+# 表间隔：上下相邻按行数、左右相邻按列数计
+GAP = 5
+
+def _text_width(text):
+    """文本显示宽度：中日韩等全角字符按2个字符计"""
+    return(sum(2 if unicodedata.east_asian_width(x) in 'WF' else 1 for x in text))
+
+def _col_widths(df, datetime_format):
+    """按表格内容计算各列显示宽度，依次为行标题各列和数据各列"""
+
+    str_format = datetime_format.replace('yyyy', '%Y').replace('mm', '%m').replace('dd', '%d')
+
+    def _width(values):
+        texts = ['' if pd.isnull(x) else
+                 pd.Timestamp(x).strftime(str_format) if isinstance(x, (datetime.date, np.datetime64)) else
+                 '{0:.10g}'.format(x) if isinstance(x, float) else str(x) for x in pd.unique(pd.Series(list(values), dtype=object))]
+        return(max([_text_width(x) for x in texts] + [0]))
+
+    # 行标题：各层取值及层名，最后一列另含列标题的层名
+    widths = [_width(list(df.index.get_level_values(i)) + [df.index.names[i]] +
+                     (list(df.columns.names) if i == df.index.nlevels-1 else [])) for i in range(df.index.nlevels)]
+
+    # 数据列：各层列标题及取值
+    for j, col in enumerate(df.columns):
+        widths.append(max(_width(col if isinstance(col, tuple) else [col]), _width(df.iloc[:, j])))
+
+    return(widths)
+
+def layout(sheet_name, bands, gap=GAP):
+    """排版：bands为[表或[表, ...], ...]，返回[(表, sheet名, startrow, startcol), ...]
+
+    每个元素占一行，列表中的表左右并排，空表跳过：下一行的startrow为本行最高的表的数据行数+gap，
+    右侧的表startcol为左侧的表的数据列数+gap，表头及行标题所占的行列不计入。
+    """
+
+    tables, startrow = [], 0
+    for band in bands:
+        band = [x for x in (band if isinstance(band, (list, tuple)) else [band]) if x is not None]
+        startcol = 0
+        for df in band:
+            tables.append((df, sheet_name, startrow, startcol))
+            startcol += df.shape[1] + gap
+        if band:
+            startrow += max(df.shape[0] for df in band) + gap
+
+    return(tables)
+
+# 表头、行标题样式，与DataFrame.to_excel相同；跨行的行标题按位置取边框
+_HEADER = {'bold':True, 'align':'center', 'valign':'top'}
+_BORDERS = {'box':{'top':1, 'bottom':1, 'left':1, 'right':1}, 'first':{'top':1, 'left':1, 'right':1},
+            'middle':{'left':1, 'right':1}, 'last':{'bottom':1, 'left':1, 'right':1}}
+
+def _value(x, datetime_format):
+    """单元格取值及数字格式，与DataFrame.to_excel相同：空值写为空白，无穷写为文本"""
+
+    if x is None or (pd.api.types.is_scalar(x) and pd.isnull(x)):
+        return('', None)
+    if isinstance(x, (bool, np.bool_)):
+        return(bool(x), None)
+    if isinstance(x, (datetime.timedelta, np.timedelta64)):
+        return(pd.Timedelta(x).total_seconds() / 86400, '0')
+    if isinstance(x, (int, np.integer)):
+        return(int(x), None)
+    if isinstance(x, (float, np.floating)):
+        return(str(float(x)) if np.isinf(x) else float(x), None)
+    if isinstance(x, np.datetime64):
+        x = pd.Timestamp(x)
+    if isinstance(x, datetime.datetime):
+        return(x, datetime_format)
+    if isinstance(x, datetime.date):
+        return(x, 'YYYY-MM-DD')
+
+    return(str(x), None)
+
+def _spans(codes):
+    """多层标签的合并：codes为各层编码，返回各层每个位置是否为合并区域的首、末位置
+
+    与to_excel相同，某层及以上各层标签都与前一位置相同的并入前一位置，最后一层不合并。
+    """
+
+    n = codes.shape[1]
+    starts, ends = [], []
+    changed = np.zeros(n, dtype=bool)
+    for k in range(len(codes)):
+        changed = changed | np.r_[True, codes[k][1:] != codes[k][:-1]][:n]
+        start = changed.copy() if k < len(codes) - 1 else np.ones(n, dtype=bool)
+        starts.append(start)
+        ends.append(np.r_[start[1:], True][:n])
+
+    return(starts, ends)
+
+def _rows(df, startrow, startcol, datetime_format):
+    """逐行生成表格的单元格，版式与DataFrame.to_excel(merge_cells=True)相同
+
+    生成(行号, [(列号, 取值, 格式), ...], [(起始列, 结束列, 取值, 格式), ...])，格式为(表头边框, 数字格式)，
+    后者为同一行内的合并单元格。数据按列取数组、按行组合，不展开整表的单元格。
+    """
+
+    nlevels, index, columns = df.index.nlevels, df.index, df.columns
+
+    def _cell(col, x, border=None):
+        value, num_format = _value(x, datetime_format)
+        return((startcol + col, value, (border, num_format)))
+
+    # 表头：多层列标题逐层写出，各层名在行标题最后一列，合并相同的上层标签
+    if columns.nlevels > 1:
+        codes = np.array(columns.codes)
+        starts, ends = _spans(codes)
+        for k in range(columns.nlevels):
+            cells, merges = [_cell(nlevels - 1, columns.names[k], 'box')], []
+            values = columns.get_level_values(k)
+            for i in np.flatnonzero(starts[k]):
+                end = i + np.argmax(ends[k][i:])
+                if end > i:
+                    value, num_format = _value(values[i], datetime_format)
+                    merges.append((startcol + nlevels + i, startcol + nlevels + end, value, ('box', num_format)))
+                else:
+                    cells.append(_cell(nlevels + i, values[i], 'box'))
+            yield((startrow + k, cells, merges))
+        names_row, body_row = columns.nlevels, columns.nlevels + 1
+        header = []
+    else:
+        names_row, body_row = 0, 1
+        header = [_cell(nlevels + j, x, 'box') for j, x in enumerate(columns)]
+
+    # 行标题层名：单层时有名称才写，多层时任一层有名称即全部写出
+    names = list(index.names)
+    if (names[0] if nlevels == 1 else any(x is not None for x in names)):
+        header = [_cell(k, x, 'box') for k, x in enumerate(names)] + header
+    if header:
+        yield((startrow + names_row, header, []))
+
+    # 行标题：多层时相同的上层标签跨行合并，以首行写值、边框连成一格
+    levels = [index.get_level_values(k) for k in range(nlevels)]
+    if nlevels > 1:
+        starts, ends = _spans(np.array(index.codes))
+    else:
+        starts = ends = [np.ones(len(df), dtype=bool)]
+    border = {(True, True):'box', (True, False):'first', (False, False):'middle', (False, True):'last'}
+
+    # 数据：日期列转为datetime，其余直接取数组
+    arrays = [x.dt.to_pydatetime() if pd.api.types.is_datetime64_dtype(x.dtype) else x.values
+              for _, x in df.items()]
+    for i, row in enumerate(zip(*arrays) if arrays else ((),) * len(df)):
+        cells = [_cell(k, levels[k][i] if starts[k][i] else None, border[(bool(starts[k][i]), bool(ends[k][i]))])
+                 for k in range(nlevels)]
+        cells += [_cell(nlevels + j, x) for j, x in enumerate(row)]
+        yield((startrow + body_row + i, cells, []))
+
+def _write_sheet(book, sheet_name, tables, datetime_format, styles):
+    """写出一页：各表的单元格逐行生成，按行号归并后依次写出，左右并排的表按行交错"""
+
+    sheet = book.add_worksheet(sheet_name)
+
+    # 列宽自适应
+    widths = {}
+    for df, _, startrow, startcol in tables:
+        for i, width in enumerate(_col_widths(df, datetime_format)):
+            widths[startcol+i] = max(widths.get(startcol+i, 0), width)
+    for col, width in widths.items():
+        sheet.set_column(col, col, min(width, 100) + 2)
+
+    def _style(key):
+        if key not in styles:
+            border, num_format = key
+            style = dict(_HEADER, **_BORDERS[border]) if border else {}
+            if num_format:
+                style['num_format'] = num_format
+            styles[key] = book.add_format(style) if style else None
+        return(styles[key])
+
+    rows = heapq.merge(*[_rows(df, startrow, startcol, datetime_format) for df, _, startrow, startcol in tables],
+                       key=lambda x: x[0])
+    for row, cells, merges in rows:
+        for col, value, key in cells:
+            sheet.write(row, col, value, _style(key))
+        for first, last, value, key in merges:
+            sheet.merge_range(row, first, row, last, value, _style(key))
+
+def _flat(df):
+    """多层表头、行标题展开为单层字段，供parquet、csv输出"""
+
+    df = df.reset_index() if any(x is not None for x in df.index.names) or df.index.nlevels > 1 else df.copy()
+    df.columns = ['|'.join(str(y) for y in x if str(y) != '') if isinstance(x, tuple) else str(x) for x in df.columns]
+
+    return(df)
+
+def _write_data(path, sheet_name, tables, formats):
+    """各表另存为parquet、csv：与工作簿同名的目录下，文件名为sheet名及序号"""
+
+    folder = os.path.splitext(path)[0]
+    os.makedirs(folder, exist_ok=True)
+    for i, (df, *_) in enumerate(tables):
+        name = os.path.join(folder, '{0}_{1}'.format(sheet_name, i))
+        data = _flat(df)
+        if 'parquet' in formats:
+            data.to_parquet(name + '.parquet', index=False)
+        if 'csv' in formats:
+            data.to_csv(name + '.csv', index=False, encoding='utf-8-sig')
+
+class Workbook(object):
+    """后台写出的工作簿：add放入队列即返回，close等待写完，写出失败时抛出异常
+
+    depth为队列中待写的页数上限，计算过快时add等待，避免积压的表占用内存。
+    """
+
+    def __init__(self, path, datetime_format='yyyy年mm月', formats=(), depth=2):
+        unknown = set(formats) - {'parquet', 'csv'}
+        if unknown:
+            raise ValueError('不支持的输出格式：' + ','.join(sorted(unknown)))
+
+        self.path = path
+        self.datetime_format = datetime_format
+        self.formats = list(formats)
+        self.sheets = []
+        self.error = None
+        self._queue = queue.Queue(depth)
+        self._thread = threading.Thread(target=self._worker, name='write:' + os.path.basename(path), daemon=True)
+        self._thread.start()
+
+    def _worker(self):
+        with stage('write_excel', file=os.path.basename(self.path)) as rec:
+            rec['rows_in'] = 0
+            try:
+                book, styles = xlsxwriter.Workbook(self.path, {'constant_memory':True}), {}
+                try:
+                    while True:
+                        item = self._queue.get()
+                        if item is None:
+                            break
+                        if self.error is not None: # 已失败：继续取出队列，不阻塞add
+                            continue
+                        sheet_name, tables = item
+                        rec['rows_in'] += rows([x[0] for x in tables])
+                        try:
+                            _write_sheet(book, sheet_name, tables, self.datetime_format, styles)
+                            if self.formats:
+                                _write_data(self.path, sheet_name, tables, self.formats)
+                        except Exception as e:
+                            self.error = e
+                finally:
+                    book.close()
+            except Exception as e:
+                self.error = self.error or e
+
+    def write(self, sheet_name, tables):
+        """写入一页已定位的表：[(表, sheet名, startrow, startcol), ...]"""
+
+        if sheet_name in self.sheets:
+            raise ValueError('sheet已写入：' + sheet_name)
+        if not self._thread.is_alive():
+            raise RuntimeError('工作簿已关闭：' + self.path)
+        self.sheets.append(sheet_name)
+        self._queue.put((sheet_name, list(tables)))
+
+    def add(self, sheet_name, bands):
+        """按排版写入一页，bands见layout"""
+        self.write(sheet_name, layout(sheet_name, bands))
+
+    def close(self):
+        """等待写完；写出失败时抛出异常"""
+
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self.error is not None:
+            raise self.error
+
+        return(self.path)
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exc_type, exc, tb):
+        # 已有异常时只等待后台线程结束，不覆盖原异常
+        if exc_type is None:
+            self.close()
+        else:
+            try:
+                self.close()
+            except Exception:
+                pass
+
+def write_excel(str_file_name, tables, datetime_format='yyyy年mm月', formats=()):
+    """输出工作簿：tables为[(表, sheet名, startrow, startcol), ...]，按sheet首次出现的顺序写出"""
+
+    sheets = {}
+    for x in tables:
+        sheets.setdefault(x[1], []).append(x)
+
+    with Workbook(str_file_name, datetime_format, formats) as book:
+        for sheet_name, lst in sheets.items():
+            book.write(sheet_name, lst)
+
+    return(str_file_name)